@@ -0,0 +1,91 @@
+# Copyright 2023 Google LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Compares compile latency over TCP and Unix domain socket transports, for a
+# table wide enough that its TABLE_SCHEMAS payload runs to megabytes of JSON.
+#
+#   python scripts/benchmark-transport.py --columns=5000 --iterations=20
+
+import asyncio
+import statistics
+import time
+
+from absl import app
+from absl import flags
+from absl import logging
+
+from malloy import Runtime
+from malloy.data.duckdb import DuckDbConnection
+from malloy.runtime import CompileCache
+from malloy.service import ServiceManager
+
+log = logging
+
+_COLUMNS = flags.DEFINE_integer('columns', 5000, 'Columns in the wide table')
+_ITERATIONS = flags.DEFINE_integer('iterations', 20,
+                                   'Timed compiles per transport')
+
+
+def wide_connection(columns):
+  connection = DuckDbConnection()
+  select = ', '.join(
+      f'{i} AS column_with_a_fairly_long_name_{i}' for i in range(columns))
+  connection.get_connection().execute(f'CREATE TABLE wide AS SELECT {select}')
+  return connection
+
+
+async def time_compiles(transport_type, connection, iterations):
+  service_manager = ServiceManager(transport_type=transport_type)
+  # Compile results are not cached, so every compile streams the schema.
+  rt = Runtime(service_manager=service_manager,
+               compile_cache=CompileCache(max_entries=0))
+  rt.add_connection(connection)
+  rt.load_source("source: wide is duckdb.table('wide')")
+  query = 'run: wide -> { select: column_with_a_fairly_long_name_0 }'
+  try:
+    # The first compile boots the compiler and fills the schema cache.
+    await rt.get_sql(query=query)
+    timings = []
+    for _ in range(iterations):
+      start = time.perf_counter()
+      await rt.get_sql(query=query)
+      timings.append((time.perf_counter() - start) * 1000)
+    return timings
+  finally:
+    rt.shutdown()
+
+
+async def run_benchmark():
+  connection = wide_connection(_COLUMNS.value)
+  log.info(f'Compiling against a {_COLUMNS.value} column table')
+  for transport_type in ('tcp', 'unix'):
+    timings = await time_compiles(transport_type, connection, _ITERATIONS.value)
+    log.info(f'  {transport_type:>4}: median {statistics.median(timings):.1f}'
+             f' ms, min {min(timings):.1f} ms, max {max(timings):.1f} ms')
+
+
+def main(_):
+  asyncio.run(run_benchmark())
+
+
+if __name__ == '__main__':
+  logging.set_verbosity(logging.INFO)
+  app.run(main)
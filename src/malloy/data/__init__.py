@@ -25,9 +25,13 @@
 from malloy.data.connection import ConnectionInterface
 from malloy.data.connection_manager import ConnectionManagerInterface, DefaultConnectionManager
 from malloy.data.query_results import QueryResultsInterface
-from malloy.data.schema_cache import SchemaCache
+from malloy.data.schema_cache import (InMemorySchemaCacheBackend, SchemaCache,
+                                      SchemaCacheBackend,
+                                      SqliteSchemaCacheBackend)
 
 __all__ = [
     "ConnectionInterface", "ConnectionManagerInterface",
-    "DefaultConnectionManager", "QueryResultsInterface", "SchemaCache"
+    "DefaultConnectionManager", "InMemorySchemaCacheBackend",
+    "QueryResultsInterface", "SchemaCache", "SchemaCacheBackend",
+    "SqliteSchemaCacheBackend"
 ]
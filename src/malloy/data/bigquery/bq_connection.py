@@ -25,13 +25,17 @@
 from __future__ import annotations
 
 from ..connection import ConnectionInterface
+from ..query_results import DEFAULT_BATCH_SIZE, QueryResultsInterface
 
 import importlib
+import threading
 
 from absl import logging
-from collections.abc import Sequence
+from collections.abc import Callable, Sequence
+from typing import Any
 from google.cloud import bigquery
 from google.api_core.gapic_v1 import client_info
+from requests.adapters import HTTPAdapter
 
 
 def set_malloy_user_agent():
@@ -42,37 +46,175 @@ def set_malloy_user_agent():
 
 MALLOY_USER_AGENT = set_malloy_user_agent()
 
+# Below this many rows the REST API is faster than opening a read session.
+DEFAULT_STORAGE_MIN_ROWS = 10000
+
+
+class BigQueryQueryResults(QueryResultsInterface):
+  """Wraps a BigQuery QueryJob. Attributes not defined here are looked up on
+  the job.
+
+  When get_storage_client is set, results of at least storage_min_rows rows
+  are downloaded through the BigQuery Storage Read API, smaller results use
+  the REST API.
+  """
+
+  def __init__(self,
+               job: bigquery.QueryJob,
+               get_storage_client: Callable[[], Any] = None,
+               max_stream_count: int = None,
+               storage_min_rows: int = 0):
+    self._job = job
+    self._get_storage_client = get_storage_client
+    self._max_stream_count = max_stream_count
+    self._storage_min_rows = storage_min_rows
+
+  @property
+  def job(self) -> bigquery.QueryJob:
+    return self._job
+
+  def __getattr__(self, name):
+    return getattr(self._job, name)
+
+  def to_dataframe(self, **kwargs):
+    return self._job.to_dataframe(**self._download_options(kwargs))
+
+  def to_arrow(self, **kwargs):
+    return self._job.to_arrow(**self._download_options(kwargs))
+
+  def iter_batches(self, batch_size: int = DEFAULT_BATCH_SIZE):
+    if self._get_storage_client is None:
+      rows = self._job.result(page_size=batch_size)
+      batches = rows.to_arrow_iterable()
+    else:
+      rows = self._job.result()
+      batches = rows.to_arrow_iterable(
+          bqstorage_client=self._storage_client(rows),
+          max_stream_count=self._max_stream_count)
+    for batch in batches:
+      for offset in range(0, batch.num_rows, batch_size):
+        yield batch.slice(offset, batch_size)
+
+  def _storage_client(self, rows):
+    if (rows.total_rows or 0) < self._storage_min_rows:
+      return None
+    return self._get_storage_client()
+
+  def _download_options(self, options):
+    if self._get_storage_client is None or "bqstorage_client" in options:
+      return options
+    storage_client = self._storage_client(self._job.result())
+    if storage_client is None:
+      return {"create_bqstorage_client": False} | options
+    return {"bqstorage_client": storage_client} | options
+
 
 class BigQueryConnection(ConnectionInterface):
   """Basic implementation of a Malloy ConnectionInterface for BigQuery. """
 
-  def __init__(self, name: str = "bigquery"):
+  def __init__(self, name: str = "bigquery", http_pool_size: int = None):
     self._name = name
     self._log = logging
     self._client_options = {
         "client_info": client_info.ClientInfo(user_agent=MALLOY_USER_AGENT)
     }
+    self._http_pool_size = http_pool_size
+    self._client = None
+    self._client_lock = threading.Lock()
+    self._use_storage_api = False
+    self._max_stream_count = None
+    self._storage_min_rows = DEFAULT_STORAGE_MIN_ROWS
+    self._storage_client = None
+    self._storage_client_lock = threading.Lock()
 
   def get_name(self) -> str:
     return self._name
 
   def with_options(self, options) -> BigQueryConnection:
-    self._client_options = self._client_options | options
+    with self._client_lock:
+      self._client_options = self._client_options | options
+      self._client = None
+    with self._storage_client_lock:
+      self._storage_client = None
+    return self
+
+  def with_http_pool_size(self, size: int) -> BigQueryConnection:
+    """Sizes the HTTP connection pool of the client for concurrent use."""
+    with self._client_lock:
+      self._http_pool_size = size
+      self._client = None
+    return self
+
+  def with_storage_api(
+      self,
+      enabled: bool = True,
+      max_stream_count: int = None,
+      min_rows: int = DEFAULT_STORAGE_MIN_ROWS) -> BigQueryConnection:
+    """Downloads query results through the BigQuery Storage Read API.
+
+    Requires the google-cloud-bigquery-storage package. Results with fewer
+    than min_rows rows still use the REST API, max_stream_count caps the
+    number of parallel read streams used by iter_batches().
+    """
+    self._use_storage_api = enabled
+    self._max_stream_count = max_stream_count
+    self._storage_min_rows = min_rows
     return self
 
-  def get_client(self):
-    return bigquery.Client(**self._client_options)
+  def get_client(self) -> bigquery.Client:
+    """Returns the client shared by all calls on this connection.
+
+    bigquery.Client is safe to share across threads, it is only rebuilt when
+    the options change.
+    """
+    with self._client_lock:
+      if self._client is None:
+        self._client = self._create_client()
+      return self._client
+
+  def get_storage_client(self):
+    """Returns the BigQueryReadClient shared by all results of this
+    connection."""
+    with self._storage_client_lock:
+      if self._storage_client is None:
+        # pylint: disable-next=import-outside-toplevel
+        from google.cloud import bigquery_storage
+        self._log.debug("Creating BigQuery Storage client")
+        self._storage_client = bigquery_storage.BigQueryReadClient(
+            # TODO: Fix protected-access when alternative available
+            # pylint: disable-next=protected-access
+            credentials=self.get_client()._credentials,
+            client_info=self._client_options["client_info"])
+      return self._storage_client
+
+  def _create_client(self) -> bigquery.Client:
+    self._log.debug("Creating BigQuery client")
+    client = bigquery.Client(**self._client_options)
+    if self._http_pool_size:
+      adapter = HTTPAdapter(pool_connections=self._http_pool_size,
+                            pool_maxsize=self._http_pool_size)
+      # TODO: Fix protected-access when alternative available
+      # pylint: disable-next=protected-access
+      client._http.mount("https://", adapter)
+    return client
 
   def get_schema_for_tables(self, tables: Sequence[(str, str)]):
     schema = {"schemas": {}}
+    client = self.get_client()
     for (key, table) in tables:
       schema["schemas"][key] = self._to_struct_def(
           table,
-          self.get_client().get_table(table).schema)
+          client.get_table(table).schema)
     return schema
 
-  def run_query(self, sql: str):
-    return self.get_client().query(sql)
+  def run_query(self, sql: str) -> BigQueryQueryResults:
+    job = self.get_client().query(sql)
+    if not self._use_storage_api:
+      return BigQueryQueryResults(job)
+    return BigQueryQueryResults(job,
+                                get_storage_client=self.get_storage_client,
+                                max_stream_count=self._max_stream_count,
+                                storage_min_rows=self._storage_min_rows)
 
   def get_schema_for_sql_block(self, name, sql):
     job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
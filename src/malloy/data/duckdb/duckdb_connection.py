@@ -25,20 +25,80 @@
 from __future__ import annotations
 
 from ..connection import ConnectionInterface
+from ..query_results import DEFAULT_BATCH_SIZE, QueryResultsInterface
 
 from absl import logging
+from collections import OrderedDict
 from collections.abc import Sequence
 from pathlib import Path
 import duckdb
+import glob
+import os
 import re
+import threading
 
 
-# Implememting QueryResultsInterface methods
-def to_dataframe(self):
-  return self.fetch_df()
+class DuckDbQueryResults(QueryResultsInterface):
+  """Results of one query, held on the cursor that ran it. Attributes not
+  defined here are looked up on the cursor."""
 
+  def __init__(self, cursor: duckdb.DuckDBPyConnection):
+    self._cursor = cursor
 
-duckdb.DuckDBPyConnection.to_dataframe = to_dataframe
+  def __getattr__(self, name):
+    return getattr(self._cursor, name)
+
+  def to_dataframe(self):
+    return self._cursor.fetch_df()
+
+  def to_arrow(self):
+    # Newer DuckDb releases deprecate fetch_arrow_table() for to_arrow_table().
+    if hasattr(self._cursor, "to_arrow_table"):
+      return self._cursor.to_arrow_table()
+    return self._cursor.fetch_arrow_table()
+
+  def iter_batches(self, batch_size: int = DEFAULT_BATCH_SIZE):
+    # Newer DuckDb releases deprecate fetch_record_batch() for
+    # to_arrow_reader().
+    if hasattr(self._cursor, "to_arrow_reader"):
+      yield from self._cursor.to_arrow_reader(batch_size)
+    else:
+      yield from self._cursor.fetch_record_batch(batch_size)
+
+  def close(self):
+    self._cursor.close()
+
+
+class _FileSchemaCache:
+  """Descriptions of data files, keyed by the path, modification time and size
+  of every file they were read from, so changed files are described again."""
+
+  def __init__(self, max_entries=1024):
+    self._max_entries = max_entries
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, fingerprint):
+    with self._lock:
+      columns = self._entries.get(fingerprint)
+      if columns is not None:
+        self._entries.move_to_end(fingerprint)
+      return columns
+
+  def put(self, fingerprint, columns):
+    with self._lock:
+      self._entries[fingerprint] = columns
+      self._entries.move_to_end(fingerprint)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+
+# Shared by all connections, fingerprints hold absolute paths.
+_file_schemas = _FileSchemaCache()
 
 
 class DuckDbException(Exception):
@@ -49,21 +109,58 @@ class DuckDbConnection(ConnectionInterface):
   """Basic implementation of a Malloy ConnectionInterface for DuckDb. """
 
   _table_regex = re.compile("^duckdb:(.+)$")
-
-  def __init__(self, home_dir=None, name="duckdb"):
+  # get_schema_for_tables looks up all tables in one catalog query.
+  batches_schema_lookups = True
+
+  def __init__(self,
+               home_dir=None,
+               name="duckdb",
+               search_path_per_cursor=False,
+               *,
+               database=":memory:",
+               read_only=False,
+               threads: int = None,
+               memory_limit: str = None,
+               temp_directory=None):
+    """Creates a connection to a DuckDb database.
+
+    database is a file path for a persistent database, or ":memory:".
+    threads, memory_limit (e.g. "8GB") and temp_directory, where queries
+    spill when they exceed the memory limit, default to DuckDb's settings.
+    """
     self._log = logging
     self._name = name
     self._client_options = {}
+    self._database = str(database)
+    self._read_only = read_only
+    settings = {
+        "threads": threads,
+        "memory_limit": memory_limit,
+        "temp_directory": temp_directory,
+    }
+    self._settings = {
+        key: str(value) for key, value in settings.items() if value is not None
+    }
     if home_dir is None:
       self._home_directory = None
     else:
       self._home_directory = Path(home_dir).resolve()
+    self._search_path_per_cursor = search_path_per_cursor
+    self._applied_search_path = None
+    self._parent = None
+    self._scoped = {}
     self._con = None
+    self._con_lock = threading.Lock()
+    self._thread_state = threading.local()
     self._log.debug("DuckDbConnection(\"%s\") initialized", name)
 
   def get_name(self) -> str:
     return self._name
 
+  @property
+  def search_path_per_cursor(self) -> bool:
+    return self._search_path_per_cursor
+
   def with_options(self, options: dict) -> DuckDbConnection:
     self._client_options = options
     return self
@@ -75,34 +172,175 @@ class DuckDbConnection(ConnectionInterface):
   def set_home_dir(self, path):
     self._home_directory = path
 
+  def for_home_dir(self, path) -> DuckDbConnection:
+    """Returns a connection that resolves relative paths against path.
+
+    By default this sets the home dir of this connection. When
+    search_path_per_cursor is set, it returns a connection to the same
+    database that applies path to each of its own cursors instead, so models
+    with different home dirs can share a database without racing on the
+    connection wide setting. Scoped connections are kept per home dir, so
+    their cursors are reused by later compiles and runs.
+    """
+    if not self._search_path_per_cursor:
+      self.set_home_dir(path)
+      return self
+    if self._parent is not None:
+      return self._parent.for_home_dir(path)
+    home_dir = Path(path).resolve()
+    with self._con_lock:
+      scoped = self._scoped.get(home_dir)
+      if scoped is None:
+        scoped = DuckDbConnection(home_dir=home_dir,
+                                  name=self._name,
+                                  search_path_per_cursor=True)
+        scoped._parent = self  # pylint: disable=protected-access
+        self._scoped[home_dir] = scoped
+      return scoped
+
   def get_connection(self):
-    if self._con is None:
-      self._con = duckdb.connect(database=":memory:",
-                                 read_only=False,
-                                 config=self._client_options)
+    if self._parent is not None:
+      return self._parent.get_connection()
+    with self._con_lock:
+      if self._con is None:
+        self._con = duckdb.connect(database=self._database,
+                                   read_only=self._read_only,
+                                   config=self._settings | self._client_options)
+      # The search path is only applied when it changes, in per cursor mode
+      # each cursor gets its own.
+      if (not self._search_path_per_cursor and self._home_directory and
+          self._home_directory != self._applied_search_path):
+        self._set_search_path(self._con)
+        self._applied_search_path = self._home_directory
+      return self._con
+
+  def close(self):
+    """Closes the database, persistent databases are checkpointed first."""
+    with self._con_lock:
+      if self._con is not None:
+        self._con.close()
+        self._con = None
+        self._applied_search_path = None
+        self._thread_state = threading.local()
+      # Cursors of scoped connections belonged to the closed connection.
+      self._scoped.clear()
+
+  def cursor(self):
+    """Returns a new cursor, safe to use from its own thread."""
+    con = self.get_connection().cursor()
     if self._home_directory:
-      sql = f"SET FILE_SEARCH_PATH=\"{self._home_directory}\""
-      self._log.debug(sql)
-      self._con.execute(sql)
-    return self._con
+      self._set_search_path(con)
+    return con
+
+  def _thread_cursor(self):
+    """Returns a cursor owned by the calling thread, kept for reuse by later
+    schema fetches on that thread."""
+    state = self._thread_state
+    if getattr(state, "cursor", None) is None:
+      state.cursor = self.get_connection().cursor()
+      state.search_path = None
+    if self._home_directory and self._home_directory != state.search_path:
+      self._set_search_path(state.cursor)
+      state.search_path = self._home_directory
+    return state.cursor
+
+  def _set_search_path(self, con):
+    sql = f"SET FILE_SEARCH_PATH=\"{self._home_directory}\""
+    self._log.debug(sql)
+    con.execute(sql)
 
   def get_schema_for_tables(self, tables: Sequence[(str, str)]):
+    """Describes tables, reading columns of catalog tables in one query and
+    reusing cached descriptions of files that have not changed."""
     self._log.debug("Fetching schema for tables...")
+    con = self._thread_cursor()
+    columns = {}
+    catalog_tables = []
+    for (key, table_name) in tables:
+      fingerprint = self._file_fingerprint(table_name)
+      if fingerprint is None:
+        catalog_tables.append((key, table_name))
+        continue
+      columns[key] = _file_schemas.get(fingerprint)
+      if columns[key] is None:
+        columns[key] = self._describe(con, table_name)
+        _file_schemas.put(fingerprint, columns[key])
+
+    columns |= self._get_catalog_columns(con, catalog_tables)
     schema = {"schemas": {}}
-    con = self.get_connection()
     for (key, table_name) in tables:
-      self._log.debug("Fetching %s", table_name)
-      con.execute(f"DESCRIBE SELECT * FROM \"{table_name}\"")
-      schema["schemas"][key] = self._to_struct_def(table_name, con.fetchall())
+      if key not in columns:
+        columns[key] = self._describe(con, table_name)
+      schema["schemas"][key] = self._to_struct_def(table_name, columns[key])
     return schema
 
-  def run_query(self, sql: str):
-    """Run a SQL query against this connection"""
+  def _describe(self, con, table_name):
+    self._log.debug("Fetching %s", table_name)
+    con.execute(f"DESCRIBE SELECT * FROM \"{table_name}\"")
+    return con.fetchall()
+
+  def _get_catalog_columns(self, con, tables):
+    """Reads the columns of tables and views named table or schema.table from
+    duckdb_columns(). Tables not found are left out."""
+    names = {}
+    for (key, table_name) in tables:
+      parts = table_name.split(".")
+      if len(parts) <= 2 and all(parts):
+        names.setdefault(tuple(parts), []).append(key)
+    if not names:
+      return {}
+
+    con.execute(
+        """
+SELECT schema_name, table_name, column_name, data_type,
+       schema_name = current_schema()
+FROM   duckdb_columns()
+WHERE  database_name = current_database()
+AND    list_contains($1, table_name)
+ORDER BY column_index""", [list({name[-1] for name in names})])
+    columns = {}
+    for (schema_name, table_name, column_name, data_type,
+         is_current) in con.fetchall():
+      matches = names.get((schema_name, table_name), [])
+      if is_current:
+        matches = matches + names.get((table_name,), [])
+      for key in matches:
+        columns.setdefault(key, []).append((column_name, data_type))
+    return columns
+
+  def _file_fingerprint(self, table_name):
+    """Returns the path, modification time and size of each file table_name
+    matches, or None when it does not name local files."""
+    if "://" in table_name or not any(c in table_name for c in "./\\*"):
+      return None
+    pattern = Path(table_name)
+    if not pattern.is_absolute():
+      pattern = Path(self._home_directory or Path.cwd(), pattern)
+    try:
+      files = sorted(glob.glob(str(pattern), recursive=True))
+      fingerprint = []
+      for file in files:
+        stat = os.stat(file)
+        fingerprint.append((file, stat.st_mtime_ns, stat.st_size))
+    except OSError:
+      return None
+    return tuple(fingerprint) or None
+
+  def run_query(self, sql: str) -> DuckDbQueryResults:
+    """Run a SQL query against this connection.
+
+    Each query runs on its own cursor, so results stay valid while other
+    queries run, including from other threads.
+    """
     self._log.debug("Running Query:")
     self._log.debug(sql)
-    con = self.get_connection()
-    con.execute(sql)
-    return con
+    con = self.cursor()
+    try:
+      con.execute(sql)
+    except:
+      con.close()
+      raise
+    return DuckDbQueryResults(con)
 
   def _to_struct_def(self, table, schema):
     return {
@@ -282,8 +520,9 @@ class DuckDbConnection(ConnectionInterface):
   }
 
   def get_schema_for_sql_block(self, name: str, sql: str):
-    con = self.get_connection()
+    con = self._thread_cursor()
     con.execute(f"DESCRIBE SELECT * FROM ({sql})")
+    fields = self._map_fields(con.fetchall())
     return {
         "type": "struct",
         "dialect": "duckdb",
@@ -297,5 +536,5 @@ class DuckDbConnection(ConnectionInterface):
             "type": "basetable",
             "connectionName": self.get_name(),
         },
-        "fields": self._map_fields(con.fetchall()),
+        "fields": fields,
     }
@@ -23,6 +23,8 @@
 """An object capable of returning data needed for compiling a malloy source."""
 import abc
 
+DEFAULT_BATCH_SIZE = 100000
+
 
 class QueryResultsInterface(metaclass=abc.ABCMeta):
   """Basic definition of a Malloy connection interface. """
@@ -35,3 +37,22 @@ class QueryResultsInterface(metaclass=abc.ABCMeta):
   @abc.abstractmethod
   def to_dataframe(self):
     raise NotImplementedError
+
+  def to_arrow(self):
+    """Returns the results as a pyarrow.Table.
+
+    Connections that can produce Arrow natively override this, the default
+    converts the pandas DataFrame.
+    """
+    # pylint: disable=import-outside-toplevel
+    import pyarrow
+    return pyarrow.Table.from_pandas(self.to_dataframe(), preserve_index=False)
+
+  def iter_batches(self, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Yields the results as pyarrow.RecordBatch objects of up to batch_size
+    rows.
+
+    Connections that can stream results override this to keep memory bounded,
+    the default slices the result of to_arrow().
+    """
+    yield from self.to_arrow().to_batches(max_chunksize=batch_size)
@@ -22,39 +22,319 @@
 # schema_cache.py
 """Module for caching schema."""
 
+import abc
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
 from collections.abc import Sequence
+from contextlib import contextmanager
+from pathlib import Path
 from malloy.data.connection import ConnectionInterface
 
+# Bound of the schema cache a Runtime creates when none is given.
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class SchemaCacheBackend(metaclass=abc.ABCMeta):
+  """Storage for cached schemas, keyed by connection name and table key."""
+
+  @classmethod
+  def __subclasshook__(cls, subclass):
+    return (hasattr(subclass, "get") and callable(subclass.get) and
+            hasattr(subclass, "put") and callable(subclass.put) and
+            hasattr(subclass, "invalidate") and
+            callable(subclass.invalidate) and hasattr(subclass, "clear") and
+            callable(subclass.clear))
+
+  @abc.abstractmethod
+  def get(self, connection: str, key: str):
+    """Returns the unexpired schema for key, or None."""
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def put(self, connection: str, key: str, table: str, schema: dict,
+          expires_at: float):
+    """Stores schema, expires_at is an epoch time in seconds or None."""
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def invalidate(self, connection: str, table: str = None):
+    """Drops entries for a table key or path, or all of a connection's."""
+    raise NotImplementedError
+
+  @abc.abstractmethod
+  def clear(self):
+    raise NotImplementedError
+
+  def stats(self) -> dict:
+    """Backend specific sizing information, such as entries and bytes."""
+    return {}
+
+
+def _estimate_size(schema: dict) -> int:
+  return len(json.dumps(schema))
+
+
+class InMemorySchemaCacheBackend(SchemaCacheBackend):
+  """Keeps schemas in memory for the lifetime of the process.
+
+  When max_entries or max_bytes is set, the least recently used schemas are
+  evicted to stay within them. Sizes are estimated from the JSON encoding of
+  each schema.
+  """
+
+  def __init__(self, max_entries: int = None, max_bytes: int = None):
+    self._max_entries = max_entries
+    self._max_bytes = max_bytes
+    self._entries = OrderedDict()
+    self._bytes = 0
+    self._evictions = 0
+    self._lock = threading.Lock()
+
+  def get(self, connection: str, key: str):
+    with self._lock:
+      entry = self._entries.get((connection, key))
+      if entry is None:
+        return None
+      [_, schema, expires_at, _] = entry
+      if expires_at is not None and expires_at <= time.time():
+        self._remove((connection, key))
+        return None
+      self._entries.move_to_end((connection, key))
+      return schema
+
+  def put(self, connection: str, key: str, table: str, schema: dict,
+          expires_at: float):
+    size = _estimate_size(schema)
+    with self._lock:
+      self._remove((connection, key))
+      self._entries[(connection, key)] = (table, schema, expires_at, size)
+      self._bytes += size
+      while self._entries and self._is_over_capacity():
+        self._remove(next(iter(self._entries)))
+        self._evictions += 1
+
+  def invalidate(self, connection: str, table: str = None):
+    with self._lock:
+      for entry_key, (entry_table, _, _, _) in list(self._entries.items()):
+        if (entry_key[0] == connection and
+            table in (None, entry_key[1], entry_table)):
+          self._remove(entry_key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self) -> dict:
+    with self._lock:
+      return {
+          "entries": len(self._entries),
+          "bytes": self._bytes,
+          "evictions": self._evictions,
+      }
+
+  def _is_over_capacity(self):
+    return ((self._max_entries is not None and
+             len(self._entries) > self._max_entries) or
+            (self._max_bytes is not None and self._bytes > self._max_bytes))
+
+  def _remove(self, entry_key):
+    entry = self._entries.pop(entry_key, None)
+    if entry is not None:
+      self._bytes -= entry[3]
+
+
+class SqliteSchemaCacheBackend(SchemaCacheBackend):
+  """Persists schemas in a SQLite database so they outlive the process.
+
+  Every operation uses its own short lived SQLite connection, so one database
+  file can be shared by threads and by processes on the same host.
+  """
+
+  default_path = Path(Path.home(), ".cache", "malloy", "schema_cache.db")
+
+  def __init__(self, path=None, timeout: float = 30):
+    self._path = Path(self.default_path if path is None else path)
+    self._path.parent.mkdir(parents=True, exist_ok=True)
+    self._timeout = timeout
+    with self._connect() as conn:
+      conn.execute("PRAGMA journal_mode=WAL")
+      conn.execute("""
+CREATE TABLE IF NOT EXISTS schemas (
+  connection  TEXT NOT NULL,
+  key         TEXT NOT NULL,
+  table_path  TEXT,
+  schema      TEXT NOT NULL,
+  expires_at  REAL,
+  PRIMARY KEY (connection, key)
+)""")
+
+  @contextmanager
+  def _connect(self):
+    conn = sqlite3.connect(self._path, timeout=self._timeout)
+    try:
+      with conn:
+        yield conn
+    finally:
+      conn.close()
+
+  @staticmethod
+  def _delete_expired(conn):
+    conn.execute(
+        "DELETE FROM schemas WHERE expires_at IS NOT NULL AND expires_at <= ?",
+        (time.time(),))
+
+  def get(self, connection: str, key: str):
+    with self._connect() as conn:
+      row = conn.execute(
+          "SELECT schema, expires_at FROM schemas"
+          " WHERE connection = ? AND key = ?", (connection, key)).fetchone()
+    if row is None:
+      return None
+    [schema, expires_at] = row
+    if expires_at is not None and expires_at <= time.time():
+      return None
+    return json.loads(schema)
+
+  def put(self, connection: str, key: str, table: str, schema: dict,
+          expires_at: float):
+    with self._connect() as conn:
+      self._delete_expired(conn)
+      conn.execute("INSERT OR REPLACE INTO schemas VALUES (?, ?, ?, ?, ?)",
+                   (connection, key, table, json.dumps(schema), expires_at))
+
+  def invalidate(self, connection: str, table: str = None):
+    with self._connect() as conn:
+      if table is None:
+        conn.execute("DELETE FROM schemas WHERE connection = ?", (connection,))
+      else:
+        conn.execute(
+            "DELETE FROM schemas WHERE connection = ?"
+            " AND (key = ? OR table_path = ?)", (connection, table, table))
+
+  def clear(self):
+    with self._connect() as conn:
+      conn.execute("DELETE FROM schemas")
+
+  def stats(self) -> dict:
+    with self._connect() as conn:
+      self._delete_expired(conn)
+      [entries, size] = conn.execute(
+          "SELECT COUNT(*), COALESCE(SUM(LENGTH(schema)), 0) FROM schemas"
+      ).fetchone()
+    return {"entries": entries, "bytes": size}
+
 
 class SchemaCache:
-  """Basic schema cache. Cache schema per connection."""
+  """Basic schema cache. Cache schema per connection.
 
-  def __init__(self):
-    self._schema_cache = {}
+  Schemas are stored in an in-memory backend, bounded by max_entries and
+  max_bytes, unless another backend is given. Neither is set by default, so
+  the cache is unbounded unless configured. When ttl (in seconds) is set,
+  each entry expires that long after it was fetched.
+  """
 
-  def _cache_schema(self, connection: str, schema: {}):
+  def __init__(self,
+               backend: SchemaCacheBackend = None,
+               ttl: float = None,
+               max_entries: int = None,
+               max_bytes: int = None):
+    if backend is None:
+      backend = InMemorySchemaCacheBackend(max_entries=max_entries,
+                                           max_bytes=max_bytes)
+    self._backend = backend
+    self._ttl = ttl
+    self._hits = 0
+    self._misses = 0
+    self._stats_lock = threading.Lock()
+
+  def _count(self, hits: int = 0, misses: int = 0):
+    with self._stats_lock:
+      self._hits += hits
+      self._misses += misses
+
+  def _expires_at(self):
+    return None if self._ttl is None else time.time() + self._ttl
+
+  def _cache_schema(self, connection: str, tables: Sequence[(str, str)],
+                    schema: {}):
+    expires_at = self._expires_at()
+    table_paths = dict(tables)
     for key in schema["schemas"]:
-      self._schema_cache.setdefault(connection, {})
-      self._schema_cache[connection][key] = schema["schemas"][key]
+      self._backend.put(connection, key, table_paths.get(key),
+                        schema["schemas"][key], expires_at)
 
   def _get_cached_schema(self, connection: str, tables: Sequence[(str, str)]):
     cached_schema = {"schemas": {}}
     uncached_tables = []
     for (key, table) in tables:
-      if (connection in self._schema_cache and
-          key in self._schema_cache[connection]):
-        cached_schema["schemas"][key] = self._schema_cache[connection][key]
+      schema = self._backend.get(connection, key)
+      if schema is not None:
+        cached_schema["schemas"][key] = schema
       else:
         uncached_tables.append((key, table))
+    self._count(hits=len(cached_schema["schemas"]), misses=len(uncached_tables))
     return [cached_schema, uncached_tables]
 
+  def get_cached_schema(self, connection: str, key: str):
+    """Returns the cached schema for key without fetching, or None."""
+    return self._backend.get(connection, key)
+
+  def invalidate(self, connection: str, table: str = None):
+    """Forgets a table, by key or path, or every schema of a connection."""
+    self._backend.invalidate(connection, table)
+
+  def invalidate_sql_block(self, connection: str, name: str, sql: str):
+    self._backend.invalidate(connection, self.sql_block_key(name, sql))
+
+  def clear(self):
+    self._backend.clear()
+
+  def stats(self) -> dict:
+    """Returns entries, bytes, hits, misses and evictions."""
+    return {
+        "entries": 0,
+        "bytes": 0,
+        "evictions": 0,
+        **self._backend.stats(),
+        "hits": self._hits,
+        "misses": self._misses,
+    }
+
+  @staticmethod
+  def sql_block_key(name: str, sql: str) -> str:
+    """The cache key for a SQL block, a hash of its name and SQL text."""
+    digest = hashlib.sha256(f"{name}\0{sql}".encode("utf8")).hexdigest()
+    return f"sql_block:{digest}"
+
+  def get_schema_for_sql_block(self, connection_name: str,
+                               connection: ConnectionInterface, name: str,
+                               sql: str):
+    key = self.sql_block_key(name, sql)
+    schema = self._backend.get(connection_name, key)
+    if schema is not None:
+      self._count(hits=1)
+      return schema
+
+    self._count(misses=1)
+    schema = connection.get_schema_for_sql_block(name, sql)
+    self._backend.put(connection_name, key, None, schema, self._expires_at())
+    return schema
+
   def get_schema_for_tables(self, connection_name: str,
                             connection: ConnectionInterface,
                             tables: Sequence[(str, str)]):
     [cached_schemas,
      uncached_tables] = self._get_cached_schema(connection_name, tables)
-    new_schemas = connection.get_schema_for_tables(uncached_tables)
-    self._cache_schema(connection_name, new_schemas)
+    new_schemas = {"schemas": {}}
+    if uncached_tables:
+      new_schemas = connection.get_schema_for_tables(uncached_tables)
+      self._cache_schema(connection_name, uncached_tables, new_schemas)
     combined_schemas = {"schemas": {}}
     combined_schemas["schemas"] = {
         **new_schemas["schemas"],
@@ -21,6 +21,7 @@
 
 # __init__.py
 """This module contains a Malloy connection implementation for Snowflake."""
+from malloy.data.snowflake.connection_pool import SnowflakeConnectionPool
 from malloy.data.snowflake.snowflake_connection import SnowflakeConnection
 
-__all__ = ["SnowflakeConnection"]
+__all__ = ["SnowflakeConnection", "SnowflakeConnectionPool"]
@@ -0,0 +1,183 @@
+# Copyright 2023 Google LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# connection_pool.py
+"""Module contains a bounded pool of Snowflake connections."""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Optional, Tuple
+
+import snowflake.connector as snowflake
+
+
+class SnowflakeConnectionPool:
+  """A thread-safe pool of between min_size and max_size connections.
+
+  Connections are opened on demand. Idle connections are closed after
+  idle_timeout seconds, unless that would leave fewer than min_size open.
+  Connections idle for longer than health_check_after seconds are validated
+  before they are handed out. Checking out a connection waits at most
+  acquire_timeout seconds for one to be released when the pool is exhausted.
+  """
+
+  def __init__(self,
+               connect: Callable[[], snowflake.SnowflakeConnection],
+               min_size: int = 0,
+               max_size: int = 4,
+               idle_timeout: float = 600,
+               health_check_after: float = 60,
+               *,
+               acquire_timeout: float = 30):
+    if max_size < 1 or min_size < 0 or min_size > max_size:
+      raise ValueError(
+          f"Invalid pool size: min_size={min_size}, max_size={max_size}")
+    self._log = logging.getLogger(__name__)
+    self._connect = connect
+    self._min_size = min_size
+    self._max_size = max_size
+    self._idle_timeout = idle_timeout
+    self._health_check_after = health_check_after
+    self._acquire_timeout = acquire_timeout
+    self._idle: Deque[Tuple[snowflake.SnowflakeConnection, float]] = deque()
+    self._open = 0
+    self._closed = False
+    self._available = threading.Condition()
+
+  def acquire(self,
+              timeout: Optional[float] = None) -> snowflake.SnowflakeConnection:
+    """Checks out a connection, waiting up to timeout seconds (acquire_timeout
+    by default) for one to be released when the pool is at max_size."""
+    if timeout is None:
+      timeout = self._acquire_timeout
+    deadline = time.monotonic() + timeout
+    while True:
+      with self._available:
+        self._check_open()
+        self._close_expired()
+        while not self._idle and self._open >= self._max_size:
+          remaining = deadline - time.monotonic()
+          if remaining <= 0:
+            raise TimeoutError("Timed out waiting for a Snowflake connection")
+          self._available.wait(remaining)
+          self._check_open()
+        conn, released_at = None, None
+        if self._idle:
+          conn, released_at = self._idle.pop()
+        else:
+          self._open += 1
+
+      if conn is None:
+        return self._open_connection()
+      if self._is_healthy(conn, released_at):
+        return conn
+      self._discard(conn)
+
+  def release(self, conn: snowflake.SnowflakeConnection, discard=False):
+    """Returns a connection to the pool, or closes it when discard is set."""
+    if discard or conn.is_closed():
+      self._discard(conn)
+      return
+    with self._available:
+      if self._closed:
+        self._open -= 1
+        conn.close()
+        return
+      self._idle.append((conn, time.monotonic()))
+      self._available.notify()
+
+  @contextmanager
+  def connection(self, timeout: Optional[float] = None):
+    """Checks out a connection for the duration of a with block."""
+    conn = self.acquire(timeout)
+    try:
+      yield conn
+    finally:
+      self.release(conn)
+
+  def close(self):
+    """Closes idle connections, checked out ones are closed on release."""
+    with self._available:
+      self._closed = True
+      idle = [conn for conn, _ in self._idle]
+      self._idle.clear()
+      self._open -= len(idle)
+      self._available.notify_all()
+    for conn in idle:
+      conn.close()
+
+  def stats(self) -> Dict[str, Any]:
+    with self._available:
+      return {
+          "open": self._open,
+          "idle": len(self._idle),
+          "in_use": self._open - len(self._idle),
+          "max_size": self._max_size,
+      }
+
+  def _check_open(self):
+    if self._closed:
+      raise RuntimeError("Snowflake connection pool is closed")
+
+  def _open_connection(self) -> snowflake.SnowflakeConnection:
+    try:
+      self._log.debug("Opening pooled Snowflake connection")
+      return self._connect()
+    except:
+      with self._available:
+        self._open -= 1
+        self._available.notify()
+      raise
+
+  def _is_healthy(self, conn, released_at) -> bool:
+    if conn.is_closed():
+      return False
+    if time.monotonic() - released_at < self._health_check_after:
+      return True
+    return conn.is_valid()
+
+  def _discard(self, conn):
+    with self._available:
+      self._open -= 1
+      self._available.notify()
+    try:
+      conn.close()
+    except snowflake.Error as ex:
+      self._log.debug("Failed to close Snowflake connection: %s", ex)
+
+  def _close_expired(self):
+    """Closes connections idle past idle_timeout, oldest first, while holding
+    the pool lock."""
+    now = time.monotonic()
+    while (self._idle and self._open > self._min_size and
+           now - self._idle[0][1] >= self._idle_timeout):
+      conn, _ = self._idle.popleft()
+      self._open -= 1
+      try:
+        conn.close()
+      except snowflake.Error as ex:
+        self._log.debug("Failed to close Snowflake connection: %s", ex)
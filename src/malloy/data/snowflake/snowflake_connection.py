@@ -21,18 +21,23 @@
 """Module contains a Malloy connection for Snowflake. """
 
 from __future__ import annotations
+import asyncio
 import hashlib
 
 import logging
+import threading
 from collections.abc import Sequence
 from typing import Any, Dict, List, Optional, Tuple
 
 import pandas as pd
+import pyarrow as pa
 import snowflake.connector as snowflake
+from snowflake.connector.constants import FIELD_ID_TO_NAME
 
-from malloy.data.query_results import QueryResultsInterface
+from malloy.data.query_results import DEFAULT_BATCH_SIZE, QueryResultsInterface
 
 from ..connection import ConnectionInterface
+from .connection_pool import SnowflakeConnectionPool
 
 
 class EncloseResultRows(QueryResultsInterface):
@@ -44,6 +49,53 @@ class EncloseResultRows(QueryResultsInterface):
     return self.df
 
 
+class EncloseResultTable(QueryResultsInterface):
+  """Results fetched as Arrow, only converted to pandas when asked for."""
+
+  def __init__(self, table: pa.Table):
+    self.table = table
+
+  def to_dataframe(self):
+    return self.table.to_pandas()
+
+  def to_arrow(self):
+    return self.table
+
+
+class EncloseResultCursor(QueryResultsInterface):
+  """Results left on an open cursor and fetched on first use.
+
+  iter_batches() streams the results a chunk at a time. Streamed results are
+  not kept, so they can only be read once. The cursor holds its own result
+  set, so it does not keep a pooled connection checked out.
+  """
+
+  def __init__(self, cursor: snowflake.cursor.SnowflakeCursor):
+    self._cursor = cursor
+    self._table = None
+
+  def to_dataframe(self):
+    return self.to_arrow().to_pandas()
+
+  def to_arrow(self):
+    if self._table is None:
+      with self._cursor:
+        self._table = self._cursor.fetch_arrow_all(force_return_table=True)
+    return self._table
+
+  def iter_batches(self, batch_size: int = DEFAULT_BATCH_SIZE):
+    if self._table is not None:
+      yield from self._table.to_batches(max_chunksize=batch_size)
+      return
+    with self._cursor:
+      for table in self._cursor.fetch_arrow_batches():
+        yield from table.to_batches(max_chunksize=batch_size)
+
+  def close(self):
+    """Closes the cursor without reading the rest of the results."""
+    self._cursor.close()
+
+
 # Snowflake types mapped to Malloy types
 TYPE_MAP: Dict[str, Dict[str, str]] = {
     # strings
@@ -158,6 +210,11 @@ TYPE_MAP: Dict[str, Dict[str, str]] = {
     },
 }
 
+# Session parameters Malloy generated SQL depends on.
+DEFAULT_SESSION_PARAMETERS: Dict[str, Any] = {
+    "QUOTED_IDENTIFIERS_IGNORE_CASE": False,
+}
+
 
 def map_field_types(schema: pd.DataFrame) -> List[Dict[str, Any]]:
   fields = []
@@ -178,39 +235,129 @@ def map_field_types(schema: pd.DataFrame) -> List[Dict[str, Any]]:
   return fields
 
 
+# Result metadata type names that differ from information_schema data types.
+DESCRIBE_TYPE_MAP: Dict[str, str] = {
+    "FIXED": "NUMBER",
+    "REAL": "FLOAT",
+}
+
+
+def describe_type_name(column: snowflake.cursor.ResultMetadata) -> str:
+  type_name = FIELD_ID_TO_NAME[column.type_code]
+  return DESCRIBE_TYPE_MAP.get(type_name, type_name)
+
+
+def quote_literal(value: str) -> str:
+  escaped = value.replace("'", "''")
+  return f"'{escaped}'"
+
+
 class SnowflakeConnection(ConnectionInterface):
   """Basic implementation of a Malloy ConnectionInterface for Snowflake."""
 
+  # get_schema_for_tables looks up all tables in one information_schema query.
+  batches_schema_lookups = True
+
   def __init__(self, name: str = "snowflake"):
     self._log = logging.getLogger(__name__)
     self._name = name
     self._client_options: Dict[str, Any] = {}
+    self._session_parameters: Dict[str, Any] = dict(DEFAULT_SESSION_PARAMETERS)
+    self._pool_options: Dict[str, Any] = {}
+    self._pool: Optional[SnowflakeConnectionPool] = None
+    self._pool_lock = threading.Lock()
     self._conn: Optional[snowflake.SnowflakeConnection] = None
 
   def with_options(self, options: Dict[str, Any]) -> SnowflakeConnection:
     self._client_options = options
+    self._reset_pool()
+    return self
+
+  def with_session_parameters(
+      self, parameters: Dict[str, Any]) -> SnowflakeConnection:
+    """Adds session parameters, applied once when the connection is opened."""
+    self._session_parameters = self._session_parameters | parameters
+    self._reset_pool()
+    return self
+
+  def with_pool_options(self, **options) -> SnowflakeConnection:
+    """Configures the connection pool, see SnowflakeConnectionPool for the
+    available options (min_size, max_size, idle_timeout, health_check_after,
+    acquire_timeout).
+    """
+    self._pool_options = self._pool_options | options
+    self._reset_pool()
     return self
 
   def get_name(self) -> str:
     return self._name
 
+  def get_pool(self) -> SnowflakeConnectionPool:
+    with self._pool_lock:
+      if self._pool is None:
+        self._pool = SnowflakeConnectionPool(
+            lambda: snowflake.connect(**self._connect_options()),
+            **self._pool_options)
+      return self._pool
+
   def get_connection(self) -> snowflake.SnowflakeConnection:
-    if self._conn is None:
-      self._conn = snowflake.connect(**self._client_options)
-    return self._conn
+    """Returns a connection owned by this instance and reused across calls.
 
-  def _get_schema_df(
-      self, tables: Sequence[Tuple[str, str]]) -> Dict[str, pd.DataFrame]:
-    schema_dfs: Dict[str, pd.DataFrame] = {}
-    for key, table_name in tables:
-      query = f"""
-SELECT column_name AS "column_name",
-       data_type   AS "data_type"
+    It is opened outside the pool and closed by close() or when the options
+    change. Queries run on pooled connections, see connection().
+    """
+    with self._pool_lock:
+      if self._conn is None:
+        self._conn = snowflake.connect(**self._connect_options())
+      return self._conn
+
+  def connection(self):
+    """Checks out a pooled connection for the duration of a with block."""
+    return self.get_pool().connection()
+
+  def close(self):
+    self._reset_pool()
+
+  def _reset_pool(self):
+    with self._pool_lock:
+      pool, self._pool = self._pool, None
+      conn, self._conn = self._conn, None
+    if pool is not None:
+      pool.close()
+    if conn is not None:
+      conn.close()
+
+  def _connect_options(self) -> Dict[str, Any]:
+    session_parameters = self._session_parameters | self._client_options.get(
+        "session_parameters", {})
+    return self._client_options | {"session_parameters": session_parameters}
+
+  def _get_schema_df(self,
+                     tables: Sequence[Tuple[str, str]],
+                     conn=None) -> Dict[str, pd.DataFrame]:
+    """Fetches the columns of all tables in one information_schema query and
+    splits them into one frame per key."""
+    if not tables:
+      return {}
+    names = ", ".join(
+        sorted({quote_literal(table_name) for _, table_name in tables}))
+    query = f"""
+SELECT table_schema AS "table_schema",
+       table_name   AS "table_name",
+       column_name  AS "column_name",
+       data_type    AS "data_type"
 FROM   information_schema.columns
-WHERE  table_name = '{table_name}'
-OR concat(table_schema, '.', table_name) = '{table_name}'
+WHERE  table_name IN ({names})
+OR concat(table_schema, '.', table_name) IN ({names})
+ORDER BY table_schema, table_name, ordinal_position
 """
-      schema_dfs[key] = self.run_query(query).to_dataframe()
+    columns = self._run_query(query, conn=conn).to_dataframe()
+    qualified_names = columns["table_schema"] + "." + columns["table_name"]
+    schema_dfs: Dict[str, pd.DataFrame] = {}
+    for key, table_name in tables:
+      matches = ((columns["table_name"] == table_name) |
+                 (qualified_names == table_name))
+      schema_dfs[key] = columns.loc[matches, ["column_name", "data_type"]]
     return schema_dfs
 
   def get_schema_for_sql_block(self, name: str, sql: str):
@@ -237,18 +384,43 @@ OR concat(table_schema, '.', table_name) = '{table_name}'
 
     hash_str = hashlib.md5(sql.encode()).hexdigest()
     temp_table_name = f"tt_{hash_str}"
-    self._run_query(f"""
+    try:
+      schema_df = self._describe_schema_df(sql)
+    except snowflake.Error as ex:
+      self._log.debug("Describe failed, using a temp table: %s", ex)
+      schema_df = None
+    if schema_df is None:
+      schema_df = self._temp_table_schema_df(temp_table_name, sql)
+    self._log.debug("Schemas: %s", schema_df.to_string())
+    return to_struct_def(temp_table_name, schema_df)
+
+  def _describe_schema_df(self, sql: str) -> Optional[pd.DataFrame]:
+    """Reads the columns of sql from result metadata, without running it."""
+    with self.connection() as conn, conn.cursor() as cursor:
+      metadata = cursor.describe(sql)
+    if metadata is None:
+      return None
+    return pd.DataFrame({
+        "column_name": [column.name for column in metadata],
+        "data_type": [describe_type_name(column) for column in metadata],
+    })
+
+  def _temp_table_schema_df(self, temp_table_name: str,
+                            sql: str) -> pd.DataFrame:
+    # The temp table only exists in the session that created it.
+    with self.connection() as conn:
+      self._run_query(f"""
 CREATE OR REPLACE TEMP TABLE "{temp_table_name}"
 AS
   SELECT *
   FROM ({sql}) AS x
   WHERE FALSE;
 """,
-                    need_data=False)
-
-    schema_dfs = self._get_schema_df([(temp_table_name, temp_table_name)])
-    self._log.debug("Schemas: %s", schema_dfs[temp_table_name].to_string())
-    return to_struct_def(temp_table_name, schema_dfs[temp_table_name])
+                      need_data=False,
+                      conn=conn)
+      schema_dfs = self._get_schema_df([(temp_table_name, temp_table_name)],
+                                       conn=conn)
+    return schema_dfs[temp_table_name]
 
   def get_schema_for_tables(self, tables: Sequence[Tuple[str, str]]):
 
@@ -275,24 +447,92 @@ AS
       schema["schemas"][key] = to_struct_def(table_name, schema_dfs[key])
     return schema
 
+  def _execute(self, sql: str, conn) -> snowflake.cursor.SnowflakeCursor:
+    """Runs sql on a new cursor of conn, which the caller must close."""
+    self._log.debug("Running query: %s", sql)
+    cursor = conn.cursor()
+    try:
+      result = cursor.execute(sql)
+    except:
+      cursor.close()
+      raise
+    if result is None:
+      cursor.close()
+      return None
+    return cursor
+
   def _run_query(self,
                  sql: str,
-                 need_data=True) -> Optional[QueryResultsInterface]:
+                 need_data=True,
+                 conn=None) -> Optional[QueryResultsInterface]:
     """
     Runs a query against the connection.
     For some queries we do not care about the resulting data. ex: DML queries.
     We should pass need_data = False for such queries.
+    Uses conn when given, otherwise a connection checked out from the pool
+    until the results are fetched.
     """
-    self._log.debug("Running query: %s", sql)
-    conn = self.get_connection()
-    with conn.cursor() as session:
-      cursor = session.execute(
-          "ALTER SESSION SET QUOTED_IDENTIFIERS_IGNORE_CASE = FALSE;")
-      result = cursor.execute(sql)
-      if result and need_data:
-        return EncloseResultRows(result.fetch_pandas_all())
+    if conn is None:
+      with self.connection() as pooled_conn:
+        return self._run_query(sql, need_data, pooled_conn)
+    cursor = self._execute(sql, conn)
+    if cursor is None:
+      return None
+    with cursor:
+      if need_data:
+        return EncloseResultTable(
+            cursor.fetch_arrow_all(force_return_table=True))
     return None
 
+  async def run_query_async(
+      self,
+      sql: str,
+      poll_interval: float = 0.1,
+      max_poll_interval: float = 5.0) -> QueryResultsInterface:
+    """Submits a query and waits for it without blocking the event loop.
+
+    The query status is polled with exponential backoff, starting at
+    poll_interval seconds. No connection is held while the query runs. As with
+    run_query, results are fetched lazily and can be streamed.
+    """
+    loop = asyncio.get_running_loop()
+    query_id = await loop.run_in_executor(None, self._submit_query, sql)
+    self._log.debug("Submitted query %s", query_id)
+    delay = poll_interval
+    while await loop.run_in_executor(None, self._is_query_running, query_id):
+      await asyncio.sleep(delay)
+      delay = min(delay * 2, max_poll_interval)
+    return await loop.run_in_executor(None, self._fetch_query_results, query_id)
+
+  def _submit_query(self, sql: str) -> str:
+    self._log.debug("Submitting query: %s", sql)
+    with self.connection() as conn, conn.cursor() as cursor:
+      cursor.execute_async(sql)
+      return cursor.sfqid
+
+  def _is_query_running(self, query_id: str) -> bool:
+    with self.connection() as conn:
+      status = conn.get_query_status_throw_if_error(query_id)
+      return conn.is_still_running(status)
+
+  def _fetch_query_results(self, query_id: str) -> QueryResultsInterface:
+    with self.connection() as conn:
+      cursor = conn.cursor()
+      try:
+        cursor.get_results_from_sfqid(query_id)
+      except:
+        cursor.close()
+        raise
+    return EncloseResultCursor(cursor)
+
   def run_query(self, sql: str) -> QueryResultsInterface:
-    """Runs a query against the connection"""
-    return self._run_query(sql) or EncloseResultRows(pd.DataFrame())
+    """Runs a query against the connection, results are fetched lazily.
+
+    The pooled connection is released once the query has run, the results
+    stay on the returned cursor until they are read or closed.
+    """
+    with self.connection() as conn:
+      cursor = self._execute(sql, conn)
+    if cursor is None:
+      return EncloseResultRows(pd.DataFrame())
+    return EncloseResultCursor(cursor)
@@ -28,14 +28,19 @@ import grpc
 import hashlib
 import json
 import os
+import threading
 
 from absl import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import NamedTuple
 
 from malloy.data.connection import ConnectionInterface
 from malloy.data.connection_manager import ConnectionManagerInterface, DefaultConnectionManager
-from malloy.data.schema_cache import SchemaCache
-from malloy.service import ServiceManager
+from malloy.data.duckdb import DuckDbConnection
+from malloy.data.schema_cache import DEFAULT_MAX_BYTES, SchemaCache
+from malloy.service import ChannelPool, ServiceManager
 from malloy.services.v1.compiler_pb2_grpc import CompilerStub
 from malloy.services.v1.compiler_pb2 import CompileRequest, CompileDocument, CompilerRequest, SqlBlockSchema
 
@@ -48,6 +53,122 @@ class MalloyRuntimeError(Exception):
   pass
 
 
+class CompileResult(NamedTuple):
+  """The outcome of a successful compile."""
+  sql: str
+  connection: str
+  prepared_result: str
+  problems: list
+
+
+class CompileCache():
+  """Size bounded LRU cache of compile results.
+
+  Entries are keyed by a hash of the compiled document and query. Each entry
+  also records the imported documents and the table and SQL block schemas the
+  compile used, and is only returned while those are unchanged.
+  """
+
+  def __init__(self, max_entries: int = 256):
+    self._max_entries = max_entries
+    self._entries = OrderedDict()
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+
+  def get(self, key: str, is_valid) -> CompileResult:
+    """Returns the result for key if is_valid(dependencies) holds, else None."""
+    entry = self._entries.get(key)
+    if entry is not None and not is_valid(entry[1]):
+      del self._entries[key]
+      entry = None
+
+    if entry is None:
+      self._misses += 1
+      return None
+
+    self._entries.move_to_end(key)
+    self._hits += 1
+    return entry[0]
+
+  def put(self, key: str, result: CompileResult, dependencies: dict):
+    if self._max_entries <= 0:
+      return
+    self._entries[key] = (result, dependencies)
+    self._entries.move_to_end(key)
+    while len(self._entries) > self._max_entries:
+      self._entries.popitem(last=False)
+      self._evictions += 1
+
+  def clear(self):
+    self._entries.clear()
+
+  def stats(self) -> dict:
+    return {
+        "entries": len(self._entries),
+        "hits": self._hits,
+        "misses": self._misses,
+        "evictions": self._evictions,
+    }
+
+
+# Compiled by Runtime.warm_up(). Reads a SQL block schema so the compiler runs
+# its full request loop, against an in-memory DuckDB database.
+WARM_UP_SOURCE = """
+query: warm_up is duckdb.sql("SELECT 1 AS one") -> { select: one }
+"""
+
+
+class SchemaFetchExecutors():
+  """Bounded thread pools that run schema fetches, one per connection.
+
+  The pools are shared by every compile of a Runtime, so a connection's limit
+  caps its concurrent schema fetches across all of them.
+  """
+
+  def __init__(self, default_limit: int = 4):
+    self._default_limit = default_limit
+    self._limits = {}
+    self._executors = {}
+    self._lock = threading.Lock()
+
+  def set_limit(self, connection_name: str, limit: int):
+    if limit < 1:
+      raise ValueError(f"Schema fetch limit must be at least 1, got {limit}")
+    with self._lock:
+      self._limits[connection_name] = limit
+      executor = self._executors.pop(connection_name, None)
+    if executor is not None:
+      executor.shutdown(wait=False)
+
+  def limit(self, connection_name: str) -> int:
+    return self._limits.get(connection_name, self._default_limit)
+
+  def executor(self, connection_name: str) -> ThreadPoolExecutor:
+    with self._lock:
+      executor = self._executors.get(connection_name)
+      if executor is None:
+        executor = ThreadPoolExecutor(
+            max_workers=self.limit(connection_name),
+            thread_name_prefix=f"malloy-schema-{connection_name}")
+        self._executors[connection_name] = executor
+      return executor
+
+  def shutdown(self):
+    with self._lock:
+      executors, self._executors = self._executors, {}
+    for executor in executors.values():
+      executor.shutdown(wait=False)
+
+
+def _digest(content) -> str:
+  if not isinstance(content, (bytes, str)):
+    content = json.dumps(content, sort_keys=True)
+  if isinstance(content, str):
+    content = content.encode("utf8")
+  return hashlib.sha256(content).hexdigest()
+
+
 class Runtime():
   """Malloy runtime class for loading, compiling, and running .malloy files"""
   ready_state = [grpc.ChannelConnectivity.READY]
@@ -60,14 +181,37 @@ class Runtime():
       self,
       connection_manager: ConnectionManagerInterface = DefaultConnectionManager(
       ),
-      service_manager=ServiceManager()):
+      service_manager=ServiceManager(),
+      *,
+      channel_pool_size: int = 1,
+      compile_cache: CompileCache = None,
+      schema_cache: SchemaCache = None,
+      schema_fetch_concurrency: int = 4,
+      warm_up: bool = False):
     self._log = logging
     self._connection_manager = connection_manager
     self._service_manager = service_manager
     self._was_entered = False
-    self._schema_cache = SchemaCache()
+    if schema_cache is None:
+      # Bounded, so a long lived Runtime does not grow without limit.
+      schema_cache = SchemaCache(max_bytes=DEFAULT_MAX_BYTES)
+    self._schema_cache = schema_cache
+    self._schema_fetchers = SchemaFetchExecutors(schema_fetch_concurrency)
+    if compile_cache is None:
+      compile_cache = CompileCache()
+    self._compile_cache = compile_cache
+    self._problems = []
     # Setting grpc max message size to 50mb.
     self._grpc_options = [("grpc.max_receive_message_length", 1024 * 1024 * 50)]
+    self._channel_pool = ChannelPool(size=channel_pool_size,
+                                     options=self._grpc_options)
+    self._warm_up_task = None
+    if warm_up:
+      try:
+        asyncio.get_running_loop()
+        self.warm_up()
+      except RuntimeError:
+        self._log.warning("Skipping warm up, no event loop is running")
     self._log.debug("Runtime initialized")
 
   def __enter__(self):
@@ -75,7 +219,7 @@ class Runtime():
     return self
 
   def __exit__(self, *ex):
-    self._service_manager.shutdown()
+    self.shutdown()
     self._was_entered = False
 
   def add_connection(self, connection: ConnectionInterface) -> Runtime:
@@ -83,20 +227,73 @@ class Runtime():
     self._connection_manager.add_connection(connection)
     return self
 
+  def with_schema_fetch_concurrency(self, connection_name: str,
+                                    limit: int) -> Runtime:
+    """Limit concurrent schema fetches for one connection, across all of this
+    Runtime's compiles."""
+    self._schema_fetchers.set_limit(connection_name, limit)
+    return self
+
+  def warm_up(self, compile_query: bool = True) -> asyncio.Task:
+    """Starts the compiler service in the background and, if compile_query is
+    set, compiles WARM_UP_SOURCE so the first real compile runs on a warm
+    compiler. Returns the task doing the work."""
+    if self._warm_up_task is None:
+      self._warm_up_task = asyncio.create_task(self._warm_up(compile_query))
+    return self._warm_up_task
+
+  async def ready(self, timeout: float = None) -> bool:
+    """Waits up to timeout seconds for the compiler service and any warm up.
+    Returns whether the service is ready, for use in readiness probes."""
+    try:
+      await asyncio.wait_for(self._wait_ready(), timeout)
+    except asyncio.TimeoutError:
+      pass
+    return self._service_manager.is_ready()
+
+  async def _wait_ready(self):
+    if self._warm_up_task is not None:
+      await asyncio.shield(self._warm_up_task)
+    await self._service_manager.ready()
+
+  async def _warm_up(self, compile_query: bool):
+    if not await self._service_manager.ready() or not compile_query:
+      return
+    connection_manager = DefaultConnectionManager()
+    connection_manager.add_connection(DuckDbConnection())
+    session = CompileSession(connection_manager=connection_manager,
+                             schema_cache=SchemaCache(),
+                             file_name=Path(os.getcwd(), "__warm-up__.malloy"),
+                             file_dir=Path(os.getcwd()),
+                             source=WARM_UP_SOURCE,
+                             named_query="warm_up")
+    try:
+      await self._run_session(session, retry=False)
+    except Exception as ex:  # pylint: disable=broad-exception-caught
+      self._log.warning("Compiler warm up failed: %s", ex)
+      return
+    if session.error:
+      self._log.warning("Compiler warm up failed: %s", session.error)
+
   def shutdown(self):
+    warm_up_task, self._warm_up_task = self._warm_up_task, None
+    if (warm_up_task is not None and not warm_up_task.done() and
+        not warm_up_task.get_loop().is_closed()):
+      warm_up_task.cancel()
+    self._channel_pool.close()
+    self._schema_fetchers.shutdown()
     self._service_manager.shutdown()
 
   def load_file(self, file):
-    self._is_file = True
     file_path = Path(file).resolve()
     self._file_dir = file_path.parent
     self._file_name = file_path
+    self._source = None
     self._log.debug("Loading file: %s", self._file_name)
     self._log.debug("  import_path: %s", self._file_dir)
     return self
 
   def load_source(self, source: str, import_path: str = None):
-    self._is_file = False
     self._source = source
     if import_path is None:
       import_path = os.getcwd()
@@ -111,99 +308,244 @@ class Runtime():
     return await self.compile_malloy(named_query=named_query, query=query)
 
   async def compile_malloy(self, named_query: str = None, query: str = None):
-    self._sql = None
-    self._connection = None
     if named_query is None and query is None:
       self._log.error("Parameter named_query or query is required to get_sql()")
       return
 
-    service = await self._service_manager.get_service()
-
-    if not self._service_manager.is_ready():
-      self._log.error(
-          "Service manager failed to report ready state, compile ending")
+    session = await self._compile(named_query=named_query, query=query)
+    if session is None:
       return
 
-    self._log.debug("Using compiler service: %s", service)
-    self._init_compile_state(named_query=named_query, query=query)
-
-    async with grpc.aio.insecure_channel(service,
-                                         options=self._grpc_options) as channel:
-      stub = CompilerStub(channel)
-      self._response_stream = stub.CompileStream(self)
-      state = channel.get_state()
-      while state not in self.ready_state and state not in self.error_state:
-        await channel.wait_for_state_change(state)
-        state = channel.get_state()
-
-      if state in self.ready_state:
-        await self._compile_completed.wait()
-      else:
-        raise MalloyRuntimeError("Channel not in ready state", state)
-
-      if self._error:
-        raise MalloyRuntimeError(self._error)
-
-    return [self._sql, self._connection]
+    return [session.sql, session.connection]
 
   async def run(self, query: str = None, named_query: str = None):
     [sql, connection_name] = await self.get_sql(query=query,
                                                 named_query=named_query)
-    return self._run_sql(sql, connection_name)
+    return await self._run_sql(sql, connection_name)
 
   async def get_sql_and_run(self, query: str = None, named_query: str = None):
-    [sql, connection_name] = await self.get_sql(query=query,
-                                                named_query=named_query)
-    return [self._run_sql(sql, connection_name), sql, self._prepared_result]
+    session = await self._compile(named_query=named_query, query=query)
+    return [
+        await self._run_sql(session.sql, session.connection), session.sql,
+        session.prepared_result
+    ]
 
   async def compile_model(self):
-    service = await self._service_manager.get_service()
+    session = await self._compile()
+    if session is None or session.sql is None:
+      return None
 
-    if not self._service_manager.is_ready():
-      self._log.error(
-          "Service manager failed to report ready state, compile ending")
-      return
+    return json.loads(session.sql)
 
-    self._log.debug("Using compiler service: %s", service)
-    self._init_compile_state()
+  def get_problems(self):
+    """Problems reported by the most recently completed compile."""
+    return self._problems
 
-    async with grpc.aio.insecure_channel(service,
-                                         options=self._grpc_options) as channel:
-      stub = CompilerStub(channel)
-      self._response_stream = stub.CompileStream(self)
+  def get_compile_cache_stats(self) -> dict:
+    return self._compile_cache.stats()
+
+  async def _compile(self, named_query: str = None, query: str = None):
+    session = self._new_session(named_query, query)
+
+    cache_key = session.cache_key()
+    if cache_key is not None:
+      result = self._compile_cache.get(
+          cache_key, lambda deps: self._is_unchanged(session, deps))
+      if result is not None:
+        self._log.debug("Using cached compile result: %s", cache_key)
+        self._problems = result.problems
+        return result
+
+    completed = await self._run_session(session)
+    if completed is False:
+      # Compiles have no side effects, so one that was cut off by a failed
+      # service is retried once on a fresh stream.
+      self._log.warning("Retrying compile after compiler service failure")
+      session = self._new_session(named_query, query)
+      completed = await self._run_session(session, retry=False)
+    if completed is None:
+      return None
+    self._problems = session.problems
+
+    if session.error:
+      raise MalloyRuntimeError(session.error)
+
+    result = CompileResult(sql=session.sql,
+                           connection=session.connection,
+                           prepared_result=session.prepared_result,
+                           problems=session.problems)
+    if cache_key is not None and result.sql is not None:
+      self._compile_cache.put(cache_key, result, session.dependencies)
+    return result
+
+  def _new_session(self, named_query: str, query: str) -> CompileSession:
+    return CompileSession(connection_manager=self._connection_manager,
+                          schema_cache=self._schema_cache,
+                          file_name=self._file_name,
+                          file_dir=self._file_dir,
+                          source=self._source,
+                          named_query=named_query,
+                          query=query,
+                          schema_fetchers=self._schema_fetchers)
+
+  async def _run_session(self, session: CompileSession, retry=True) -> bool:
+    """Runs session on a compiler service and returns True once it ends.
+
+    Returns None when no service is running. When retry is set and the service
+    was unreachable or dropped the stream, reports it and returns False.
+    """
+    async with self._service_manager.lease() as service:
+      if not self._service_manager.is_ready():
+        self._log.error(
+            "Service manager failed to report ready state, compile ending")
+        return None
+
+      self._log.debug("Using compiler service: %s", service)
+      channel = await self._channel_pool.get_channel(service)
       state = channel.get_state()
-      while state not in self.ready_state and state not in self.error_state:
-        await channel.wait_for_state_change(state)
-        state = channel.get_state()
-
       if state in self.ready_state:
-        await self._compile_completed.wait()
-      else:
+        await session.run(CompilerStub(channel))
+        if not (retry and session.stream_failed):
+          return True
+      elif not retry:
         raise MalloyRuntimeError("Channel not in ready state", state)
 
-      if self._error:
-        raise MalloyRuntimeError(self._error)
-
-    if self._sql is None:
-      return None
-
-    return json.loads(self._sql)
-
-  def get_problems(self):
-    return self._problems
-
-  def _run_sql(self, sql: str, connection_name: str):
+    self._channel_pool.discard(service)
+    await self._service_manager.report_failure(service)
+    return False
+
+  def _is_unchanged(self, session: CompileSession, dependencies: dict):
+    for url, digest in dependencies["imports"].items():
+      if session.document_digest(url) != digest:
+        return False
+    for (connection_name, key), digest in dependencies["schemas"].items():
+      schema = self._schema_cache.get_cached_schema(connection_name, key)
+      if schema is None or _digest(schema) != digest:
+        return False
+    return True
+
+  async def _run_sql(self, sql: str, connection_name: str):
     if connection_name == self.default_connection:
       connection_name = self._connection_manager.get_default_connection_name()
     self._log.debug("Running query and getting results from connection: %s",
                     connection_name)
     self._log.debug(sql)
-    if self._error:
-      raise MalloyRuntimeError(self._error)
     if sql is None:
       return None
-    return self._connection_manager.get_connection(connection_name).run_query(
-        sql)
+    connection = _scoped_connection(
+        self._connection_manager.get_connection(connection_name),
+        self._file_dir)
+    # Connections that can submit queries without blocking let concurrent
+    # runs overlap on one event loop.
+    if hasattr(connection, "run_query_async"):
+      return await connection.run_query_async(sql)
+    return connection.run_query(sql)
+
+
+def _connection_for_home_dir(connection, home_dir):
+  """Points connection at home_dir for resolving relative table paths."""
+  for_home_dir = getattr(connection, "for_home_dir", None)
+  if callable(for_home_dir):
+    return for_home_dir(home_dir)
+  set_home_dir = getattr(connection, "set_home_dir", None)
+  if callable(set_home_dir):
+    set_home_dir(home_dir)
+  return connection
+
+
+def _scoped_connection(connection, home_dir):
+  """Scopes connection to home_dir when it keeps a search path per cursor.
+
+  Other connections are returned as is, so the home dir they were given is
+  kept.
+  """
+  if getattr(connection, "search_path_per_cursor", False):
+    return connection.for_home_dir(home_dir)
+  return connection
+
+
+class CompileSession():
+  """State of a single compile stream with the Malloy compiler service.
+
+  A session is the request iterator for one CompileStream call, answering the
+  compiler's IMPORT, TABLE_SCHEMAS and SQL_BLOCK_SCHEMAS requests until it
+  receives COMPLETE or ERROR. Keeping this state off of the Runtime lets one
+  Runtime drive many compiles concurrently.
+  """
+
+  def __init__(self,
+               *,
+               connection_manager: ConnectionManagerInterface,
+               schema_cache: SchemaCache,
+               file_name: Path,
+               file_dir: Path,
+               source: str = None,
+               named_query: str = None,
+               query: str = None,
+               schema_fetchers: SchemaFetchExecutors = None):
+    self._log = logging
+    self._connection_manager = connection_manager
+    self._schema_cache = schema_cache
+    self._schema_fetchers = schema_fetchers
+    self._file_name = file_name
+    self._file_dir = file_dir
+    self._source = source
+    self._compile_completed = asyncio.Event()
+    self._first_request_sent = False
+    self._seen_responses = set()
+    self._last_response = None
+    self._response_stream = None
+    if query is not None:
+      self._query_type = "query"
+      self._query = query
+    elif named_query is not None:
+      self._query_type = "named"
+      self._query = named_query
+    else:
+      self._query_type = "compile"
+      self._query = None
+    self._initial_request = None
+    self.dependencies = {"imports": {}, "schemas": {}}
+    self.sql = None
+    self.connection = None
+    self.prepared_result = None
+    self.problems = []
+    self.error = None
+    self.stream_failed = False
+
+  def cache_key(self) -> str:
+    """A hash of the compiled document and query, None if unreadable."""
+    try:
+      request = self._generate_initial_compile_request()
+    except Exception:  # pylint: disable=broad-exception-caught
+      return None
+    return _digest(request.SerializeToString(deterministic=True))
+
+  def document_digest(self, url: str) -> str:
+    try:
+      return _digest(self._create_document(url).content)
+    except OSError:
+      return None
+
+  async def run(self, stub: CompilerStub):
+    """Streams this session to the compiler and waits for it to finish."""
+    self._response_stream = stub.CompileStream(self)
+    self._response_stream.add_done_callback(self._on_stream_done)
+    try:
+      await self._compile_completed.wait()
+    finally:
+      # The channel outlives the compile, so end the stream explicitly.
+      if not self._response_stream.done():
+        self._response_stream.cancel()
+
+  def _on_stream_done(self, _):
+    # A stream that fails while sending is never read from, so end the
+    # session here rather than waiting on a response that will not come.
+    if not self._compile_completed.is_set():
+      self._log.error("Compiler stream ended before the compile completed")
+      self.error = "Compiler stream ended before the compile completed"
+      self.stream_failed = True
+      self._compile_completed.set()
 
   def __aiter__(self):
     return self
@@ -220,8 +562,16 @@ class Runtime():
       self._compile_completed.set()
       raise StopAsyncIteration from ex
 
-    while not self._compile_completed.is_set() and self._last_response is None:
-      await self._parse_response()
+    try:
+      while not self._compile_completed.is_set(
+      ) and self._last_response is None:
+        await self._parse_response()
+    except Exception as ex:
+      self._log.error(ex)
+      self.error = f"Compiler stream failed: {ex}"
+      self.stream_failed = True
+      self._compile_completed.set()
+      raise StopAsyncIteration from ex
 
     if self._compile_completed.is_set():
       raise StopAsyncIteration
@@ -235,13 +585,13 @@ class Runtime():
 
       if self._last_response.type == CompilerRequest.Type.TABLE_SCHEMAS:
         self._log.debug("  generating TABLE_SCHEMAS request")
-        request = self._generate_table_schema_request()
+        request = await self._generate_table_schema_request()
         self._last_response = None
         return request
 
       if self._last_response.type == CompilerRequest.Type.SQL_BLOCK_SCHEMAS:
         self._log.debug("  generating SQL_BLOCK_SCHEMAS request")
-        request = self._generate_sql_block_schemas_request()
+        request = await self._generate_sql_block_schemas_request()
         self._last_response = None
         return request
 
@@ -253,28 +603,11 @@ class Runtime():
     self._compile_completed.set()
     raise StopAsyncIteration
 
-  def _init_compile_state(self, named_query=None, query=None):
-    self._compile_completed = asyncio.Event()
-    self._compile_completed.clear()
-    self._first_request_sent = False
-    self._seen_responses = []
-    self._last_response = None
-    self._prepared_result = None
-    self._sql = None
-    self._problems = []
-    if query is not None:
-      self._query_type = "query"
-      self._query = query
-    elif named_query is not None:
-      self._query_type = "named"
-      self._query = named_query
-    else:
-      self._query_type = "compile"
-    self._error = None
-
   def _generate_initial_compile_request(self):
+    if self._initial_request is not None:
+      return self._initial_request
     self._log.debug("Generating initial compile request")
-    if self._is_file:
+    if self._source is None:
       compile_request = CompileRequest(type=CompileRequest.Type.COMPILE,
                                        document=self._create_document(
                                            self._file_name))
@@ -286,18 +619,21 @@ class Runtime():
       compile_request.query = self._query
     elif self._query_type == "named":
       compile_request.named_query = self._query
+    self._initial_request = compile_request
     return compile_request
 
   def _generate_import_request(self):
     request = CompileRequest(type=CompileRequest.Type.REFERENCES)
     imports = []
     for url in self._last_response.import_urls:
-      imports.append(self._create_document(url))
+      document = self._create_document(url)
+      self.dependencies["imports"][url] = _digest(document.content)
+      imports.append(document)
     request.references.extend(imports)
     self._log.debug(request)
     return request
 
-  def _generate_table_schema_request(self):
+  async def _generate_table_schema_request(self):
     # Compiler should really be telling us which connection to use per table...
     tables_per_connection_to_fetch = {}
     self._log.debug("  requested table schemas:\n%s",
@@ -316,54 +652,76 @@ class Runtime():
 
     # self._log.debug("  fetching table schemas:\n{}".format(
     #     tables_per_connection_to_fetch))
-    combined_schemas = {"schemas": {}}
+    fetches = []
     for connection_name, tables in tables_per_connection_to_fetch.items():
       self._log.debug("  using connection: %s", connection_name)
 
       #TODO: Remove this when default connections go away
       orig_connection_name = connection_name
-      if connection_name == self.default_connection:
+      if connection_name == Runtime.default_connection:
         connection_name = self._connection_manager.get_default_connection_name()
         self._log.debug("  default connection: %s", connection_name)
 
-      connection = self._connection_manager.get_connection(connection_name)
-
-      set_home_dir = getattr(connection, "set_home_dir", None)
-      if callable(set_home_dir):
-        set_home_dir(self._file_dir)
+      connection = _connection_for_home_dir(
+          self._connection_manager.get_connection(connection_name),
+          self._file_dir)
 
       if connection:
         # tables = tables_per_connection_to_fetch.get(connection)
         self._log.debug("  tables: %s", tables)
-        schemas = self._schema_cache.get_schema_for_tables(
-            connection_name, connection, tables)
-        #TODO: Remove this when default connections go away
-        for key in schemas["schemas"]:
-          schemas["schemas"][key]["structRelationship"][
-              "connectionName"] = orig_connection_name
-
-        combined_schemas["schemas"] = {
-            **combined_schemas["schemas"],
-            **schemas["schemas"]
-        }
+        # Connections that batch their own lookups get every table at once,
+        # others get a round robin share per concurrent fetch.
+        chunks = 1
+        if (self._schema_fetchers is not None and
+            not getattr(connection, "batches_schema_lookups", False)):
+          chunks = max(
+              1, min(self._schema_fetchers.limit(connection_name), len(tables)))
+        for i in range(chunks):
+          fetches.append((connection_name, orig_connection_name, connection,
+                          tables[i::chunks]))
       else:
         raise MalloyRuntimeError(f"Unknown connection {connection_name}")
 
+    results = await asyncio.gather(*[
+        self._fetch_schema(connection_name,
+                           self._schema_cache.get_schema_for_tables,
+                           connection_name, connection, tables)
+        for (connection_name, _, connection, tables) in fetches
+    ])
+
+    combined_schemas = {"schemas": {}}
+    for fetch, schemas in zip(fetches, results):
+      [connection_name, orig_connection_name, _, _] = fetch
+      for key, schema in schemas["schemas"].items():
+        self.dependencies["schemas"][(connection_name, key)] = _digest(schema)
+        #TODO: Remove this when default connections go away
+        # Copied so the rename never leaks back into the schema cache.
+        relationship = dict(schema["structRelationship"],
+                            connectionName=orig_connection_name)
+        combined_schemas["schemas"][key] = dict(schema,
+                                                structRelationship=relationship)
+
     request = CompileRequest(type=CompileRequest.Type.TABLE_SCHEMAS,
                              schema=json.dumps(combined_schemas))
     self._log.debug(request)
     return request
 
-  def _generate_sql_block_schemas_request(self):
+  async def _generate_sql_block_schemas_request(self):
     # Compiler should really be telling us which connection to use per table...
     self._log.debug(self._last_response.sql_block.sql)
     connection_name = self._last_response.sql_block.connection
     self._log.debug("  fetching sql_block schema from connection: %s",
                     connection_name)
-    connection = self._connection_manager.get_connection(connection_name)
+    connection = _scoped_connection(
+        self._connection_manager.get_connection(connection_name),
+        self._file_dir)
     sql = self._last_response.sql_block.sql
     name = self._last_response.sql_block.name
-    schema = connection.get_schema_for_sql_block(name, sql)
+    schema = await self._fetch_schema(
+        connection_name, self._schema_cache.get_schema_for_sql_block,
+        connection_name, connection, name, sql)
+    key = SchemaCache.sql_block_key(name, sql)
+    self.dependencies["schemas"][(connection_name, key)] = _digest(schema)
     self._log.debug("  schema:\n%s", json.dumps(schema, indent=2))
     request = CompileRequest(type=CompileRequest.Type.SQL_BLOCK_SCHEMAS,
                              sql_block_schemas=[
@@ -373,6 +731,14 @@ class Runtime():
                              ])
     return request
 
+  async def _fetch_schema(self, connection_name: str, fetch, *args):
+    """Runs fetch(*args) on the bounded executor of connection_name."""
+    executor = None
+    if self._schema_fetchers is not None:
+      executor = self._schema_fetchers.executor(connection_name)
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, fetch, *args)
+
   def _create_document(self, path, internal=False):
     file_path = path
     if path != self._file_name:
@@ -393,8 +759,11 @@ class Runtime():
   async def _parse_response(self):
     self._log.debug("Awaiting compiler response")
     self._last_response = await self._response_stream.read()
-    if self._last_response is None:
+    if self._last_response is None or self._last_response is grpc.aio.EOF:
       self._log.error("No response received, ending session")
+      self._last_response = None
+      self.stream_failed = True
+      self._compile_completed.set()
       return
 
     last_response_hash = hashlib.md5(
@@ -406,20 +775,20 @@ class Runtime():
       self._compile_completed.set()
       return
 
-    self._seen_responses.append(last_response_hash)
+    self._seen_responses.add(last_response_hash)
 
     if self._last_response.type == CompilerRequest.Type.COMPLETE:
       self._log.debug("Received compile COMPLETE, ending session")
-      self._prepared_result = self._last_response.prepared_result
-      self._sql = self._last_response.content
-      self._connection = self._last_response.connection
-      self._problems = self._parse_last_response_problems()
+      self.prepared_result = self._last_response.prepared_result
+      self.sql = self._last_response.content
+      self.connection = self._last_response.connection
+      self.problems = self._parse_last_response_problems()
       self._compile_completed.set()
       return
 
     if self._last_response.type == CompilerRequest.Type.ERROR:
       self._log.info("Received response type ERROR")
-      self._error = self._last_response.content
+      self.error = self._last_response.content
       self._compile_completed.set()
       return
 
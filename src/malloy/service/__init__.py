@@ -21,6 +21,7 @@
 
 # __init__.py
 """Module provides connections and management of a Malloy compiler service. """
+from malloy.service.channel_pool import (ChannelPool)
 from malloy.service.service_manager import (ServiceManager)
 
-__all__ = ["ServiceManager"]
+__all__ = ["ChannelPool", "ServiceManager"]
@@ -0,0 +1,111 @@
+# Copyright 2023 Google LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# channel_pool.py
+"""Module keeps long-lived gRPC channels to the Malloy compiler service."""
+import asyncio
+import grpc
+
+from absl import logging
+
+# Keep idle HTTP/2 connections alive between compiles so they stay warm.
+DEFAULT_KEEPALIVE_OPTIONS = {
+    "grpc.keepalive_time_ms": 30 * 1000,
+    "grpc.keepalive_timeout_ms": 10 * 1000,
+    "grpc.keepalive_permit_without_calls": 1,
+    "grpc.http2.max_pings_without_data": 0,
+}
+
+
+class ChannelPool:
+  """A fixed size pool of channels per compiler service target.
+
+  Channels are handed out round robin and are only replaced when they are
+  found in a failed state, when they belong to a different event loop, or when
+  the pool is closed.
+  """
+  ready_state = [grpc.ChannelConnectivity.READY]
+  error_state = [
+      grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+      grpc.ChannelConnectivity.SHUTDOWN
+  ]
+
+  def __init__(self, size: int = 1, options=None):
+    if size < 1:
+      raise ValueError(f"Channel pool size must be at least 1, got {size}")
+    self._log = logging
+    self._size = size
+    self._options = list({
+        **DEFAULT_KEEPALIVE_OPTIONS,
+        **dict(options or [])
+    }.items())
+    self._channels = {}
+    self._next_slot = {}
+
+  def size(self) -> int:
+    return self._size
+
+  async def get_channel(self, target: str) -> grpc.aio.Channel:
+    """Returns a pooled channel for target, once it is ready or has failed."""
+    loop = asyncio.get_running_loop()
+    slots = self._channels.setdefault(target, [None] * self._size)
+    slot = self._next_slot.get(target, 0)
+    self._next_slot[target] = (slot + 1) % self._size
+
+    entry = slots[slot]
+    if entry is not None and not self._is_usable(loop, *entry):
+      self._log.debug("Replacing channel %d for %s", slot, target)
+      self._close_channel(*entry)
+      entry = None
+
+    if entry is None:
+      self._log.debug("Opening channel %d for %s", slot, target)
+      entry = (loop, grpc.aio.insecure_channel(target, options=self._options))
+      slots[slot] = entry
+
+    channel = entry[1]
+    state = channel.get_state(try_to_connect=True)
+    while state not in self.ready_state and state not in self.error_state:
+      await channel.wait_for_state_change(state)
+      state = channel.get_state(try_to_connect=True)
+    return channel
+
+  def discard(self, target: str):
+    """Closes and forgets all channels to target."""
+    for entry in self._channels.pop(target, []):
+      if entry is not None:
+        self._close_channel(*entry)
+    self._next_slot.pop(target, None)
+
+  def close(self):
+    """Closes all pooled channels."""
+    for target in list(self._channels):
+      self.discard(target)
+
+  def _is_usable(self, loop, channel_loop, channel):
+    if channel_loop is not loop:
+      return False
+    return channel.get_state() not in self.error_state
+
+  def _close_channel(self, loop, channel):
+    if loop.is_closed() or not loop.is_running():
+      return
+    asyncio.run_coroutine_threadsafe(channel.close(), loop)
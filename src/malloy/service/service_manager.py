@@ -21,21 +21,33 @@
 
 # service_manager.py
 """Module manages the service(s) needed by the Malloy runtime. """
+from __future__ import annotations
+
 import asyncio
+import contextlib
+import grpc
+import os
 import platform
 import re
+import shutil
 import sys
+import tempfile
 
 from absl import flags
 from absl import logging
 from datetime import datetime, timedelta
 from pathlib import Path
 
+from malloy.service import transport
+from malloy.service.shared_service import SharedService
+
 _MALLOY_DIALECTS = flags.DEFINE_list(
     "malloy_dialects", "",
     "List of dialects to initialize by default in ipython runtime")
 
 _TIMEOUT_SECONDS = 30
+_RESTART_BACKOFF_SECONDS = 0.5
+_MAX_RESTART_BACKOFF_SECONDS = 30
 
 
 class ServiceManager:
@@ -65,37 +77,313 @@ class ServiceManager:
     service_path = f"{Path(Path(__file__).parent, service_name).resolve()}"
     return service_path
 
-  def __init__(self, external_service: str = None):
+  def __init__(self,
+               external_service: str = None,
+               pool_size: int = 1,
+               *,
+               supervise: bool = True,
+               health_check_interval: float = 10,
+               health_check_timeout: float = 5,
+               shared: bool = False,
+               shared_state_dir: str = None,
+               transport_type: str = transport.TCP):
+    """Creates a manager for pool_size compiler service processes, or one per
+    CPU when pool_size is None. Ignored when external_service is set.
+
+    When supervise is set, each process is watched and restarted with backoff
+    if it exits or fails a health check, run every health_check_interval
+    seconds.
+
+    When shared is set, the manager attaches to a single compiler daemon that
+    is reused by every process on the host, spawning it only if none is
+    running, and pool_size and supervise are ignored. The daemon stops once
+    the last process using it shuts down. Its state lives in shared_state_dir,
+    by default a per user directory under $XDG_RUNTIME_DIR or the temp dir.
+
+    transport_type picks how spawned services listen, on a localhost TCP port
+    ("tcp") or on a Unix domain socket ("unix").
+    """
+    if pool_size is None:
+      pool_size = os.cpu_count() or 1
+    if pool_size < 1:
+      raise ValueError(f"Service pool size must be at least 1, got {pool_size}")
     self._log = logging
     self._is_ready = asyncio.Event()
+    self._spawn_lock = asyncio.Lock()
     self._external_service = external_service
-    self._proc = None
+    self._pool_size = pool_size
+    self._supervise = supervise
+    self._health_check_interval = health_check_interval
+    self._health_check_timeout = health_check_timeout
+    self._processes = []
+    # Processes spawned but not yet listening, killed on shutdown.
+    self._starting = set()
+    self._supervisors = []
+    self._start_task = None
+    self._shared = shared
+    self._shared_state_dir = shared_state_dir
+    self._shared_service = None
+    self._transport = transport.check_transport(transport_type)
+    self._socket_dir = None
+    self._sockets_started = 0
 
   def is_ready(self):
     return self._is_ready.is_set()
 
+  def start(self) -> asyncio.Task:
+    """Starts the service in the background, so it is booted by the time the
+    first compile needs it. Returns the task doing the work."""
+    if self._start_task is None or (self._start_task.done() and
+                                    not self._is_ready.is_set()):
+      self._start_task = asyncio.create_task(self._ensure_started())
+    return self._start_task
+
+  async def ready(self, timeout: float = None) -> bool:
+    """Starts the service if needed and waits up to timeout seconds for it.
+    Returns whether the service is ready, for use in readiness probes."""
+    try:
+      await asyncio.wait_for(asyncio.shield(self.start()), timeout)
+    except asyncio.TimeoutError:
+      pass
+    return self.is_ready()
+
+  def pool_size(self) -> int:
+    return 1 if self._external_service or self._shared else self._pool_size
+
+  def queue_depths(self) -> dict:
+    """Returns the number of compiles outstanding on each service."""
+    return {process.target: process.outstanding for process in self._processes}
+
+  def restart_counts(self) -> dict:
+    """Returns how often the process now serving each target was restarted."""
+    return {process.target: process.restarts for process in self._processes}
+
   def shutdown(self):
+    tasks, self._supervisors = self._supervisors, []
+    if self._start_task is not None:
+      tasks.append(self._start_task)
+      self._start_task = None
+    for task in tasks:
+      if not task.done() and not task.get_loop().is_closed():
+        task.cancel()
     self._kill_service()
+    shared_service, self._shared_service = self._shared_service, None
+    if shared_service is not None:
+      self._detach(shared_service)
+    if self._socket_dir is not None:
+      shutil.rmtree(self._socket_dir, ignore_errors=True)
+      self._socket_dir = None
     self._is_ready.clear()
 
+  def _detach(self, shared_service: SharedService):
+    """Detaches from the shared daemon, off the event loop when one is
+    running, since stopping the daemon blocks until it has exited."""
+    try:
+      loop = asyncio.get_running_loop()
+    except RuntimeError:
+      shared_service.detach()
+      return
+    loop.run_in_executor(None, shared_service.detach)
+
   async def get_service(self):
+    """Returns the service with the fewest outstanding compiles."""
+    await self._ensure_started()
+    return (await self._least_loaded()).target
+
+  @contextlib.asynccontextmanager
+  async def lease(self):
+    """Picks the service with the fewest outstanding compiles and counts a
+    compile against it until the block exits."""
+    await self._ensure_started()
+    process = await self._least_loaded()
+    process.outstanding += 1
+    try:
+      yield process.target
+    finally:
+      process.outstanding -= 1
+
+  async def _ensure_started(self):
     if not self._is_ready.is_set():
-      await self._spawn_service()
+      # Concurrent compiles must not each start their own service.
+      async with self._spawn_lock:
+        if not self._is_ready.is_set():
+          await self._spawn_service()
 
-    if self._external_service is None:
-      return self._internal_service
-    return self._external_service
+  async def report_failure(self, target: str):
+    """Checks the service a compile failed on and restarts it when it has
+    stopped or is unhealthy. Services that are still healthy are kept."""
+    if self._shared_service is not None:
+      if not await self._is_healthy(target):
+        # Attaching again replaces a daemon that has gone away.
+        self._log.warning("Shared compiler service %s failed", target)
+        self._is_ready.clear()
+      return
+    for process in self._processes:
+      if process.target != target or process.proc is None:
+        continue
+      if process.proc.returncode is None and await self._is_healthy(target):
+        return
+      self._log.warning("Compiler service %s failed, restarting", target)
+      process.ready.clear()
+      process.kill()
+      if not self._supervise:
+        await self._restart_unsupervised(process)
+      return
+
+  async def _restart_unsupervised(self, process: _ServiceProcess):
+    """Replaces a failed process that no supervisor will restart. If that
+    fails, the process is dropped, and the manager stops reporting ready once
+    none are left so callers fail fast until the next spawn."""
+    started = await self._start_process()
+    if process.stopped:
+      if started is not None:
+        started.kill()
+      return
+    if started is not None:
+      process.restart_as(started)
+      return
+    process.stopped = True
+    self._processes = [p for p in self._processes if p is not process]
+    if not self._processes:
+      self._is_ready.clear()
+
+  async def _least_loaded(self) -> _ServiceProcess:
+    if not self._processes:
+      return _ServiceProcess(self._internal_service)
+    if not any(process.ready.is_set() for process in self._processes):
+      # Every process is restarting, wait for the first one to come back.
+      waiters = [
+          asyncio.create_task(process.ready.wait())
+          for process in self._processes
+      ]
+      _, pending = await asyncio.wait(waiters,
+                                      timeout=_TIMEOUT_SECONDS,
+                                      return_when=asyncio.FIRST_COMPLETED)
+      for waiter in pending:
+        waiter.cancel()
+    ready = [process for process in self._processes if process.ready.is_set()]
+    return min(ready or self._processes,
+               key=lambda process: process.outstanding)
 
   async def _spawn_service(self):
     if self._external_service is not None:
       self._log.debug("Using external service: %s", self._external_service)
+      self._processes = [_ServiceProcess(self._external_service)]
       self._is_ready.set()
       return
 
-    service_path = ServiceManager.service_path()
-    self._log.debug("Starting compiler service: %s", service_path)
+    if self._shared:
+      if self._shared_service is None:
+        self._shared_service = SharedService(ServiceManager.service_path(),
+                                             self._service_args(),
+                                             self._shared_state_dir,
+                                             self._transport)
+      loop = asyncio.get_running_loop()
+      target = await loop.run_in_executor(None, self._shared_service.attach)
+      self._processes = [_ServiceProcess(target)]
+      self._internal_service = target
+      self._is_ready.set()
+      return
+
+    starts = [
+        asyncio.ensure_future(self._start_process())
+        for _ in range(self._pool_size)
+    ]
+    try:
+      started = await asyncio.gather(*starts)
+    except asyncio.CancelledError:
+      # Processes that finished starting are not in self._processes yet.
+      for start in starts:
+        if start.done() and not start.cancelled() and not start.exception():
+          if start.result() is not None:
+            start.result().kill()
+      raise
+    self._processes = [process for process in started if process is not None]
+    if self._processes:
+      self._internal_service = self._processes[0].target
+      self._is_ready.set()
+    if self._supervise:
+      self._supervisors = [
+          asyncio.create_task(self._supervise_process(process))
+          for process in self._processes
+      ]
+
+  async def _supervise_process(self, process: _ServiceProcess):
+    """Restarts process with backoff whenever it exits or fails a health
+    check, until the manager shuts it down."""
+    delay = _RESTART_BACKOFF_SECONDS
+    while not process.stopped:
+      await self._watch_process(process)
+      if process.stopped:
+        return
+      process.ready.clear()
+      self._log.warning("Compiler service %s stopped, restarting",
+                        process.target)
+      while not process.stopped:
+        await asyncio.sleep(delay)
+        started = await self._start_process()
+        if process.stopped:
+          if started is not None:
+            started.kill()
+          return
+        if started is not None:
+          process.restart_as(started)
+          delay = _RESTART_BACKOFF_SECONDS
+          break
+        delay = min(delay * 2, _MAX_RESTART_BACKOFF_SECONDS)
+
+  async def _watch_process(self, process: _ServiceProcess):
+    """Returns once process exits, killing it first if it stops answering
+    health checks. Service output is logged meanwhile, so its pipe never
+    fills up."""
+    proc = process.proc
+    output = asyncio.create_task(self._log_output(proc))
+    exited = asyncio.create_task(proc.wait())
+    try:
+      while True:
+        await asyncio.wait([exited], timeout=self._health_check_interval)
+        if exited.done():
+          return
+        if not await self._is_healthy(process.target):
+          self._log.error("Compiler service %s failed its health check",
+                          process.target)
+          process.kill()
+          await exited
+          return
+    finally:
+      output.cancel()
+      exited.cancel()
+
+  async def _log_output(self, proc):
+    while True:
+      line = await proc.stdout.readline()
+      if not line:
+        return
+      self._log.debug("Message from compiler process: %s",
+                      line.decode().rstrip())
+
+  async def _is_healthy(self, target: str) -> bool:
+    """Checks that target completes a gRPC connection handshake in time."""
+
+    async def connect(channel):
+      state = channel.get_state(try_to_connect=True)
+      while state != grpc.ChannelConnectivity.READY:
+        if state in (grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+                     grpc.ChannelConnectivity.SHUTDOWN):
+          return False
+        await channel.wait_for_state_change(state)
+        state = channel.get_state(try_to_connect=True)
+      return True
+
+    async with grpc.aio.insecure_channel(target) as channel:
+      try:
+        return await asyncio.wait_for(connect(channel),
+                                      self._health_check_timeout)
+      except asyncio.TimeoutError:
+        return False
 
-    args = ["-p", "0"]
+  def _service_args(self) -> list:
+    args = []
     if not flags.FLAGS.is_parsed():
       logging.debug("absl flags not yet parsed, attempting to parse sys.argv")
       flags.FLAGS(sys.argv, True)
@@ -103,29 +391,46 @@ class ServiceManager:
     if _MALLOY_DIALECTS.value and len(_MALLOY_DIALECTS.value):
       args.append("--dialect")
       args.extend(_MALLOY_DIALECTS.value)
+    return args
 
+  async def _start_process(self) -> _ServiceProcess:
+    service_path = ServiceManager.service_path()
+    self._log.debug("Starting compiler service: %s", service_path)
+
+    socket_path = self._next_socket_path()
+    args = [*transport.listen_args(socket_path), *self._service_args()]
     self._log.debug("Running with args: %s", args)
-    self._proc = await asyncio.create_subprocess_exec(
+    proc = await asyncio.create_subprocess_exec(
         service_path,
         *args,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.STDOUT)
+    self._starting.add(proc)
+    try:
+      return await self._wait_until_listening(proc, socket_path)
+    except asyncio.CancelledError:
+      _ServiceProcess(None, proc).kill()
+      raise
+    finally:
+      self._starting.discard(proc)
 
+  async def _wait_until_listening(self, proc,
+                                  socket_path: Path) -> _ServiceProcess:
     service_listening = re.compile(r"^Server listening on (\d+)$")
     service_errored = re.compile(r"^Error:.+$")
     errored = False
     empty_line_count = 0
+    sline = ""
     timeout = datetime.now() + timedelta(0, _TIMEOUT_SECONDS)
     while datetime.now() < timeout:
-      line = await self._proc.stdout.readline()
+      line = await proc.stdout.readline()
       if line is not None:
         sline = line.decode().rstrip()
         match = service_listening.match(sline)
         if match:
           self._log.debug("Compiler service is running: %s", sline)
-          self._internal_service = "localhost:" + match.group(1)
-          self._is_ready.set()
-          break
+          return _ServiceProcess(transport.target(match.group(1), socket_path),
+                                 proc)
 
         if service_errored.match(sline):
           errored = True
@@ -146,14 +451,54 @@ class ServiceManager:
       elif errored:
         break
 
-    if self._is_ready.is_set() is not True and errored is False:
+    if errored is False:
       self._log.error(
           "Timeout or something unexpected happened starting the compiler.\n" +
           "  Compiler service NOT running: %s", sline)
+    _ServiceProcess(None, proc).kill()
+    return None
+
+  def _next_socket_path(self) -> Path:
+    """Returns a fresh socket path for the next service, None over TCP."""
+    if self._transport != transport.UNIX:
+      return None
+    if self._socket_dir is None:
+      self._socket_dir = tempfile.mkdtemp(prefix="malloy-")
+    self._sockets_started += 1
+    return Path(self._socket_dir, f"service-{self._sockets_started}")
 
   def _kill_service(self):
-    if self._proc is None:
+    starting, self._starting = self._starting, set()
+    for proc in starting:
+      _ServiceProcess(None, proc).kill()
+    processes, self._processes = self._processes, []
+    for process in processes:
+      if process.proc is not None:
+        self._log.debug("Terminating compiler service: %s", process.target)
+      process.stopped = True
+      process.kill()
+
+
+class _ServiceProcess:
+  """A compiler service and the number of compiles outstanding on it."""
+
+  def __init__(self, target: str, proc=None):
+    self.target = target
+    self.proc = proc
+    self.outstanding = 0
+    self.restarts = 0
+    self.stopped = False
+    self.ready = asyncio.Event()
+    self.ready.set()
+
+  def restart_as(self, process: _ServiceProcess):
+    """Takes over the target and process of a newly started service."""
+    self.target = process.target
+    self.proc = process.proc
+    self.restarts += 1
+    self.ready.set()
+
+  def kill(self):
+    if self.proc is None or self.proc.returncode is not None:
       return
-    self._log.debug("Terminating compiler service")
-    self._proc.kill()
-    self._proc = None
+    self.proc.kill()
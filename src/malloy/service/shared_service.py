@@ -0,0 +1,240 @@
+# Copyright 2023 Google LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# shared_service.py
+"""Module shares one compiler service between the Python processes on a host.
+"""
+from __future__ import annotations
+
+import atexit
+import hashlib
+import json
+import os
+import re
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+from absl import logging
+from pathlib import Path
+
+from malloy.service import transport
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+_TIMEOUT_SECONDS = 30
+
+# Daemons spawned by this process, by pid, so whichever client stops one can
+# reap it.
+_spawned = {}
+
+
+class SharedService:
+  """A compiler service daemon shared by every process of one user.
+
+  The daemon's target and its clients are kept in a state file, guarded by an
+  exclusive lock on a sibling lock file. Each SharedService is one client, so
+  managers in the same process share the daemon too. The first client to
+  attach spawns the daemon and the last one to detach stops it. Clients whose
+  process exited without detaching are dropped the next time the state is
+  updated. Services started with different binaries or arguments do not
+  share a daemon.
+  """
+
+  def __init__(self,
+               service_path: str,
+               args: list,
+               state_dir: str = None,
+               transport_type: str = transport.TCP):
+    if fcntl is None:
+      raise RuntimeError("A shared compiler service needs POSIX file locks")
+    self._log = logging
+    self._service_path = service_path
+    self._args = list(args)
+    self._transport = transport.check_transport(transport_type)
+    if state_dir is None:
+      state_dir = Path(
+          os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(),
+          f"malloy-{os.getuid()}")
+    self._state_dir = Path(state_dir)
+    key = hashlib.sha256(
+        json.dumps([service_path, self._args,
+                    self._transport]).encode("utf8")).hexdigest()[:16]
+    self._lock_path = Path(self._state_dir, f"service-{key}.lock")
+    self._state_path = Path(self._state_dir, f"service-{key}.json")
+    self._log_path = Path(self._state_dir, f"service-{key}.log")
+    self._socket_path = None
+    if self._transport == transport.UNIX:
+      self._socket_path = Path(self._state_dir, f"service-{key}.sock")
+    self._client = [os.getpid(), uuid.uuid4().hex]
+    self._attached = False
+    self._detach_lock = threading.Lock()
+
+  def attach(self) -> str:
+    """Registers this client, spawning the daemon if it is not
+    running, and returns its target. Blocks, so run it off the event loop."""
+    with self._locked():
+      state = self._read_state()
+      if not self._is_running(state):
+        if state.get("pid"):
+          # The pid may since have been reused, so it is left alone.
+          self._log.warning("Shared compiler service %s is gone, replacing",
+                            state.get("target"))
+        state["pid"], state["target"] = self._spawn()
+      state["clients"] = [
+          client for client in state.get("clients", []) if _is_alive(client[0])
+      ]
+      if self._client not in state["clients"]:
+        state["clients"].append(self._client)
+      self._write_state(state)
+    if not self._attached:
+      self._attached = True
+      atexit.register(self.detach)
+    self._log.debug("Attached to shared compiler service: %s", state["target"])
+    return state["target"]
+
+  def detach(self):
+    """Unregisters this client, stopping the daemon if no clients remain.
+    Blocks, so run it off the event loop."""
+    with self._detach_lock:
+      if not self._attached:
+        return
+      self._attached = False
+    atexit.unregister(self.detach)
+    with self._locked():
+      state = self._read_state()
+      state["clients"] = [
+          client for client in state.get("clients", [])
+          if client != self._client and _is_alive(client[0])
+      ]
+      if state["clients"]:
+        self._write_state(state)
+        return
+      self._log.debug("Last client left, stopping shared compiler service: %s",
+                      state.get("target"))
+      if self._is_running(state):
+        self._stop(state["pid"], state["target"])
+      transport.remove_socket(state.get("target"))
+      self._state_path.unlink(missing_ok=True)
+
+  def clients(self) -> list:
+    """Returns the pid of each client attached to the daemon."""
+    with self._locked():
+      return [pid for pid, _ in self._read_state().get("clients", [])]
+
+  def _locked(self):
+    self._state_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return _FileLock(self._lock_path)
+
+  def _read_state(self) -> dict:
+    try:
+      return json.loads(self._state_path.read_text(encoding="utf8"))
+    except (OSError, ValueError):
+      return {}
+
+  def _write_state(self, state: dict):
+    temp_path = self._state_path.with_suffix(".tmp")
+    temp_path.write_text(json.dumps(state), encoding="utf8")
+    os.replace(temp_path, self._state_path)
+
+  def _is_running(self, state: dict) -> bool:
+    pid, target = state.get("pid"), state.get("target")
+    return bool(pid and target and _is_alive(pid) and transport.accepts(target))
+
+  def _spawn(self):
+    self._log.debug("Starting shared compiler service: %s", self._service_path)
+    args = [*transport.listen_args(self._socket_path), *self._args]
+    with open(self._log_path, "wb") as log:
+      # A new session keeps the daemon alive after this process exits.
+      # pylint: disable-next=consider-using-with
+      proc = subprocess.Popen([self._service_path, *args],
+                              stdin=subprocess.DEVNULL,
+                              stdout=log,
+                              stderr=subprocess.STDOUT,
+                              start_new_session=True)
+    service_listening = re.compile(r"^Server listening on (\d+)$", re.M)
+    deadline = time.monotonic() + _TIMEOUT_SECONDS
+    while time.monotonic() < deadline and proc.poll() is None:
+      match = service_listening.search(
+          self._log_path.read_text(encoding="utf8", errors="replace"))
+      if match:
+        _spawned[proc.pid] = proc
+        return proc.pid, transport.target(match.group(1), self._socket_path)
+      time.sleep(0.05)
+    self._log.error("Shared compiler service NOT running, see %s",
+                    self._log_path)
+    if proc.poll() is None:
+      proc.kill()
+    raise RuntimeError("Could not start the shared compiler service")
+
+  def _stop(self, pid: int, target: str):
+    try:
+      os.kill(pid, signal.SIGTERM)
+    except OSError:
+      pass
+    proc = _spawned.pop(pid, None)
+    if proc is not None:
+      try:
+        proc.wait(timeout=_TIMEOUT_SECONDS)
+      except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+      return
+    # Another process spawned the daemon and reaps it, until then it lingers
+    # as a zombie. It is stopped once it no longer accepts connections.
+    deadline = time.monotonic() + _TIMEOUT_SECONDS
+    while (_is_alive(pid) and transport.accepts(target) and
+           time.monotonic() < deadline):
+      time.sleep(0.05)
+
+
+class _FileLock:
+  """An exclusive lock on a file, held for the duration of a with block."""
+
+  def __init__(self, path: Path):
+    self._path = path
+    self._file = None
+
+  def __enter__(self):
+    # pylint: disable-next=consider-using-with
+    self._file = open(self._path, "a+", encoding="utf8")
+    fcntl.flock(self._file, fcntl.LOCK_EX)
+    return self
+
+  def __exit__(self, *ex):
+    fcntl.flock(self._file, fcntl.LOCK_UN)
+    self._file.close()
+
+
+def _is_alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+  return True
@@ -0,0 +1,83 @@
+# Copyright 2023 Google LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# transport.py
+"""Module builds the listen arguments and gRPC targets of compiler services.
+
+Services listen on a localhost TCP port by default, or on a Unix domain socket,
+which avoids the loopback TCP stack for large schema payloads.
+"""
+from __future__ import annotations
+
+import socket
+
+from pathlib import Path
+
+TCP = "tcp"
+UNIX = "unix"
+TRANSPORTS = (TCP, UNIX)
+
+
+def check_transport(transport: str) -> str:
+  if transport not in TRANSPORTS:
+    raise ValueError(f"Unknown compiler service transport: {transport}, "
+                     f"expected one of {', '.join(TRANSPORTS)}")
+  return transport
+
+
+def listen_args(socket_path: Path = None) -> list:
+  """Returns the service arguments to listen on socket_path, or on any free
+  localhost port when it is None."""
+  if socket_path is None:
+    return ["-p", "0"]
+  # The service binds to "<host>:<port>", so its socket is socket_path with
+  # ":0" appended. Remove any socket a killed service left behind.
+  Path(f"{socket_path}:0").unlink(missing_ok=True)
+  return ["-h", f"unix:{socket_path}", "-p", "0"]
+
+
+def target(port: str, socket_path: Path = None) -> str:
+  """Returns the gRPC target of a service that reported listening on port."""
+  if socket_path is None:
+    return f"localhost:{port}"
+  return f"unix:{socket_path}:0"
+
+
+def accepts(service: str, timeout: float = 1) -> bool:
+  """Returns whether service accepts connections, without speaking gRPC."""
+  try:
+    if service.startswith("unix:"):
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(service[len("unix:"):])
+    else:
+      host, port = service.rsplit(":", 1)
+      with socket.create_connection((host, int(port)), timeout=timeout):
+        pass
+    return True
+  except OSError:
+    return False
+
+
+def remove_socket(service: str):
+  """Removes the socket file of a stopped service listening on one."""
+  if service is not None and service.startswith("unix:"):
+    Path(service[len("unix:"):]).unlink(missing_ok=True)
@@ -23,15 +23,18 @@
 """Test bq_connection.py"""
 
 from collections import namedtuple
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import bigquery
 from pandas.testing import assert_frame_equal
 from malloy.data.connection import ConnectionInterface
 from malloy.data.bigquery import BigQueryConnection
+from malloy.data.bigquery.bq_connection import BigQueryQueryResults
 
 from io import StringIO
 
 import pytest
 import pandas
+import pyarrow
 
 
 def test_is_connection_interface():
@@ -49,6 +52,34 @@ def test_returns_custom_name():
   assert conn.get_name() == "custom-bigquery"
 
 
+def anonymous_connection(**kwargs):
+  return BigQueryConnection(**kwargs).with_options({
+      "credentials": AnonymousCredentials(),
+      "project": "malloy-test"
+  })
+
+
+def test_reuses_client():
+  conn = anonymous_connection()
+  assert conn.get_client() is conn.get_client()
+
+
+def test_rebuilds_client_when_options_change():
+  conn = anonymous_connection()
+  client = conn.get_client()
+  conn.with_options({"location": "EU"})
+  assert conn.get_client() is not client
+  assert conn.get_client().location == "EU"
+
+
+def test_sizes_http_pool():
+  conn = anonymous_connection(http_pool_size=32)
+  # pylint: disable-next=protected-access
+  adapter = conn.get_client()._http.get_adapter("https://bigquery")
+  # pylint: disable-next=protected-access
+  assert adapter._pool_maxsize == 32
+
+
 type_test_data = [
     # DATE
     ({
@@ -256,6 +287,70 @@ def test_maps_sql_block_types(field, expected):
   assert fields[0] == expected
 
 
+class FakeRowIterator:
+
+  def __init__(self, batches):
+    self.batches = batches
+    self.total_rows = sum(batch.num_rows for batch in batches)
+    self.bqstorage_client = None
+
+  def to_arrow_iterable(self, bqstorage_client=None, max_stream_count=None):
+    del max_stream_count
+    self.bqstorage_client = bqstorage_client
+    yield from self.batches
+
+
+class FakeQueryJob:
+  """Stands in for a bigquery.QueryJob."""
+
+  def __init__(self, batches):
+    self.rows = FakeRowIterator(batches)
+    self.page_size = None
+    self.download_options = None
+    self.job_id = "job-1"
+
+  def result(self, page_size=None):
+    self.page_size = page_size
+    return self.rows
+
+  def to_arrow(self, **kwargs):
+    self.download_options = kwargs
+    return pyarrow.Table.from_batches(self.rows.batches)
+
+
+def test_query_results_stream_batches():
+  batch = pyarrow.record_batch({"id": list(range(5))})
+  job = FakeQueryJob([batch, batch])
+  results = BigQueryQueryResults(job)
+  batches = list(results.iter_batches(2))
+  assert job.page_size == 2
+  assert [b.num_rows for b in batches] == [2, 2, 1, 2, 2, 1]
+  assert results.job_id == "job-1"
+
+
+def test_query_results_download_through_storage_api():
+  storage_client = object()
+  job = FakeQueryJob([pyarrow.record_batch({"id": list(range(5))})])
+  results = BigQueryQueryResults(job,
+                                 get_storage_client=lambda: storage_client,
+                                 storage_min_rows=5)
+  assert results.to_arrow().num_rows == 5
+  assert job.download_options == {"bqstorage_client": storage_client}
+  assert len(list(results.iter_batches(2))) == 3
+  assert job.rows.bqstorage_client is storage_client
+
+
+def test_small_query_results_download_through_rest():
+  job = FakeQueryJob([pyarrow.record_batch({"id": list(range(5))})])
+  results = BigQueryQueryResults(job,
+                                 get_storage_client=lambda: object(),
+                                 storage_min_rows=6)
+  results.to_arrow()
+  assert job.download_options == {"create_bqstorage_client": False}
+  assert len(list(results.iter_batches(2))) == 3
+  assert job.rows.bqstorage_client is None
+
+
 def bq_table(table):
   try:
     client = bigquery.Client()
@@ -23,9 +23,13 @@
 """Test duckdb_connection.py"""
 
 from malloy.data.connection import ConnectionInterface
+from malloy.data.query_results import QueryResultsInterface
 from malloy.data.duckdb import DuckDbConnection
 
+from concurrent.futures import ThreadPoolExecutor
+from duckdb import Error as DuckDbError
 from pathlib import Path
+import pyarrow
 import pytest
 
 
@@ -50,6 +54,140 @@ def test_creates_connection_with_search_path():
   assert fetch_setting(conn, "FILE_SEARCH_PATH") == parent_dir_str()
 
 
+def test_sets_search_path_only_when_changed(tmp_path):
+  duckdb = DuckDbConnection(home_dir=parent_dir())
+  conn = duckdb.get_connection()
+  conn.execute(f"SET FILE_SEARCH_PATH='{tmp_path}'")
+  duckdb.set_home_dir(parent_dir())
+  assert fetch_setting(duckdb.get_connection(),
+                       "FILE_SEARCH_PATH") == str(tmp_path)
+  duckdb.set_home_dir(tmp_path.parent)
+  assert fetch_setting(duckdb.get_connection(),
+                       "FILE_SEARCH_PATH") == str(tmp_path.parent)
+
+
+def test_search_path_per_cursor(tmp_path):
+  for name in ["a", "b"]:
+    (tmp_path / name).mkdir()
+    (tmp_path / name / "data.csv").write_text(f"name\n{name}\n")
+  duckdb = DuckDbConnection(search_path_per_cursor=True)
+  duckdb.get_connection().execute("CREATE TABLE shared AS SELECT 1 AS id")
+  model_a = duckdb.for_home_dir(tmp_path / "a")
+  model_b = duckdb.for_home_dir(tmp_path / "b")
+  sql = "SELECT name, id FROM 'data.csv', shared"
+  assert model_a.run_query(sql).fetchall() == [("a", 1)]
+  assert model_b.run_query(sql).fetchall() == [("b", 1)]
+  assert fetch_setting(duckdb.get_connection(), "FILE_SEARCH_PATH") == ""
+
+
+def test_reuses_scoped_connection_per_home_dir(tmp_path):
+  duckdb = DuckDbConnection(search_path_per_cursor=True)
+  model_a = duckdb.for_home_dir(tmp_path / "a")
+  assert duckdb.for_home_dir(tmp_path / "a") is model_a
+  assert model_a.for_home_dir(tmp_path / "a" /
+                              "..") is duckdb.for_home_dir(tmp_path)
+  assert duckdb.for_home_dir(tmp_path / "b") is not model_a
+  duckdb.close()
+  assert duckdb.for_home_dir(tmp_path / "a") is not model_a
+
+
+def test_persists_database_file(tmp_path):
+  database = tmp_path / "malloy.duckdb"
+  duckdb = DuckDbConnection(database=database)
+  duckdb.run_query("CREATE TABLE saved AS SELECT 42 AS answer")
+  duckdb.close()
+  reopened = DuckDbConnection(database=database, read_only=True)
+  assert reopened.run_query("SELECT answer FROM saved").fetchall() == [(42,)]
+  with pytest.raises(DuckDbError):
+    reopened.run_query("CREATE TABLE other AS SELECT 1")
+  reopened.close()
+
+
+def test_applies_resource_settings(tmp_path):
+  duckdb = DuckDbConnection(threads=2,
+                            memory_limit="1GB",
+                            temp_directory=tmp_path / "spill")
+  conn = duckdb.get_connection()
+  assert fetch_setting(conn, "threads") == 2
+  assert fetch_setting(conn, "temp_directory") == str(tmp_path / "spill")
+  assert fetch_setting(conn, "memory_limit") != fetch_setting(
+      DuckDbConnection().get_connection(), "memory_limit")
+
+
+class CountingDuckDbConnection(DuckDbConnection):
+  """DuckDbConnection that counts per table DESCRIBE statements"""
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.described = []
+
+  def _describe(self, con, table_name):
+    self.described.append(table_name)
+    return super()._describe(con, table_name)
+
+
+def test_describes_catalog_tables_in_one_query():
+  duckdb = CountingDuckDbConnection()
+  duckdb.get_connection().execute("""
+CREATE TABLE t AS SELECT 1 AS id, 'x' AS code;
+CREATE SCHEMA other;
+CREATE TABLE other.t AS SELECT 1.5 AS amount;
+""")
+  schema = duckdb.get_schema_for_tables([("a", "t"), ("b", "other.t")])
+  assert not duckdb.described
+  assert [f["name"] for f in schema["schemas"]["a"]["fields"]] == ["id", "code"]
+  assert [f["name"] for f in schema["schemas"]["b"]["fields"]] == ["amount"]
+
+
+def test_reuses_description_of_unchanged_files(tmp_path):
+  data = tmp_path / "data.csv"
+  data.write_text("id,code\n1,x\n")
+  duckdb = CountingDuckDbConnection(home_dir=tmp_path)
+  duckdb.get_schema_for_tables([("a", "data.csv")])
+  duckdb.get_schema_for_tables([("a", "data.csv")])
+  assert duckdb.described == ["data.csv"]
+  data.write_text("id,code,name\n1,x,y\n")
+  schema = duckdb.get_schema_for_tables([("a", "data.csv")])
+  assert duckdb.described == ["data.csv", "data.csv"]
+  assert len(schema["schemas"]["a"]["fields"]) == 3
+
+
+def test_returns_query_results_as_arrow():
+  duckdb = DuckDbConnection()
+  table = duckdb.run_query("SELECT * FROM range(5) t(i)").to_arrow()
+  assert isinstance(table, pyarrow.Table)
+  assert table.column("i").to_pylist() == [0, 1, 2, 3, 4]
+
+
+def test_iterates_query_results_in_batches():
+  duckdb = DuckDbConnection()
+  results = duckdb.run_query("SELECT * FROM range(5) t(i)")
+  batches = list(results.iter_batches(2))
+  assert all(batch.num_rows <= 2 for batch in batches)
+  values = [i for b in batches for i in b.column("i").to_pylist()]
+  assert values == list(range(5))
+
+
+def test_query_results_are_independent():
+  duckdb = DuckDbConnection()
+  first = duckdb.run_query("SELECT * FROM range(3) t(i)")
+  second = duckdb.run_query("SELECT * FROM range(5) t(i)")
+  assert isinstance(first, QueryResultsInterface)
+  assert len(first.to_dataframe()) == 3
+  assert len(second.to_dataframe()) == 5
+
+
+def test_runs_queries_from_threads():
+  duckdb = DuckDbConnection()
+
+  def count_rows(n):
+    return duckdb.run_query(f"SELECT * FROM range({n})").to_arrow().num_rows
+
+  with ThreadPoolExecutor(max_workers=4) as executor:
+    counts = list(executor.map(count_rows, range(1, 21)))
+  assert counts == list(range(1, 21))
+
+
 type_test_data = [
     ("varchar_col_1", "string", None, None),
     ("bigint_col_1", "number", "integer", None),
@@ -0,0 +1,151 @@
+# Copyright 2023 Google LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# test_connection_pool.py
+"""Test connection_pool.py"""
+
+import threading
+import time
+
+import pytest
+
+from malloy.data.snowflake import SnowflakeConnectionPool
+
+
+class FakeConnection:
+
+  def __init__(self, valid=True):
+    self.closed = False
+    self.valid = valid
+
+  def is_closed(self):
+    return self.closed
+
+  def is_valid(self):
+    return self.valid
+
+  def close(self):
+    self.closed = True
+
+
+class FakeConnector:
+
+  def __init__(self):
+    self.connections = []
+
+  def connect(self):
+    conn = FakeConnection()
+    self.connections.append(conn)
+    return conn
+
+
+def test_rejects_invalid_sizes():
+  with pytest.raises(ValueError):
+    SnowflakeConnectionPool(FakeConnector().connect, max_size=0)
+  with pytest.raises(ValueError):
+    SnowflakeConnectionPool(FakeConnector().connect, min_size=2, max_size=1)
+
+
+def test_reuses_released_connection():
+  connector = FakeConnector()
+  pool = SnowflakeConnectionPool(connector.connect)
+  with pool.connection() as first:
+    pass
+  with pool.connection() as second:
+    assert first is second
+  assert len(connector.connections) == 1
+
+
+def test_bounds_concurrent_connections():
+  connector = FakeConnector()
+  pool = SnowflakeConnectionPool(connector.connect, max_size=2)
+  running = 0
+  max_running = 0
+  lock = threading.Lock()
+
+  def work():
+    nonlocal running, max_running
+    with pool.connection():
+      with lock:
+        running += 1
+        max_running = max(max_running, running)
+      time.sleep(0.02)
+      with lock:
+        running -= 1
+
+  threads = [threading.Thread(target=work) for _ in range(6)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert max_running == 2
+  assert len(connector.connections) == 2
+
+
+def test_times_out_when_exhausted():
+  pool = SnowflakeConnectionPool(FakeConnector().connect, max_size=1)
+  with pool.connection():
+    with pytest.raises(TimeoutError):
+      pool.acquire(timeout=0.01)
+
+
+def test_times_out_by_default_when_exhausted():
+  pool = SnowflakeConnectionPool(FakeConnector().connect,
+                                 max_size=1,
+                                 acquire_timeout=0.01)
+  with pool.connection():
+    with pytest.raises(TimeoutError):
+      pool.acquire()
+
+
+def test_closes_idle_connections_above_min_size():
+  connector = FakeConnector()
+  pool = SnowflakeConnectionPool(connector.connect,
+                                 min_size=1,
+                                 max_size=3,
+                                 idle_timeout=0)
+  with pool.connection(), pool.connection():
+    pass
+  with pool.connection():
+    pass
+  assert pool.stats()["open"] == 1
+  assert [conn.closed for conn in connector.connections].count(True) == 1
+
+
+def test_replaces_unhealthy_connection():
+  connector = FakeConnector()
+  pool = SnowflakeConnectionPool(connector.connect, health_check_after=0)
+  with pool.connection() as first:
+    first.valid = False
+  with pool.connection() as second:
+    assert second is not first
+  assert first.closed
+
+
+def test_close_closes_connections():
+  connector = FakeConnector()
+  pool = SnowflakeConnectionPool(connector.connect)
+  with pool.connection() as conn:
+    pass
+  pool.close()
+  assert conn.closed
+  with pytest.raises(RuntimeError):
+    pool.acquire()
@@ -24,12 +24,18 @@
 
 from io import StringIO
 
+import hashlib
 import pandas
+import pyarrow
+import pytest
 from pandas.testing import assert_frame_equal
 from snowflake.connector import Error as SnowflakeError
+from snowflake.connector.cursor import ResultMetadata
 
 from malloy.data.connection import ConnectionInterface
 from malloy.data.snowflake import SnowflakeConnection
+from malloy.data.snowflake import snowflake_connection
+from malloy.data.snowflake.snowflake_connection import EncloseResultCursor, EncloseResultRows, EncloseResultTable
 
 
 def ensure_snowflake_connectable(conn: SnowflakeConnection):
@@ -55,6 +61,268 @@ def test_returns_custom_name():
   assert conn.get_name() == "custom-snowflake"
 
 
+def test_arrow_results_convert_to_dataframe():
+  table = pyarrow.table({"id": [1, 2], "code": ["ADK", "AKK"]})
+  results = EncloseResultTable(table)
+  assert results.to_arrow() is table
+  assert results.to_dataframe()["code"].tolist() == ["ADK", "AKK"]
+
+
+def test_dataframe_results_convert_to_arrow():
+  df = pandas.DataFrame({"id": [1, 2], "code": ["ADK", "AKK"]})
+  table = EncloseResultRows(df).to_arrow()
+  assert table.column_names == ["id", "code"]
+  assert table.column("code").to_pylist() == ["ADK", "AKK"]
+
+
+class FakeArrowCursor:
+  """Stands in for a SnowflakeCursor holding an arrow result."""
+
+  def __init__(self, table, chunk_size):
+    self.table = table
+    self.chunk_size = chunk_size
+    self.closed = False
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.closed = True
+
+  def fetch_arrow_all(self, force_return_table=False):
+    assert force_return_table
+    return self.table
+
+  def fetch_arrow_batches(self):
+    for offset in range(0, self.table.num_rows, self.chunk_size):
+      yield self.table.slice(offset, self.chunk_size)
+
+
+def test_cursor_results_stream_batches():
+  cursor = FakeArrowCursor(pyarrow.table({"id": list(range(7))}), 4)
+  results = EncloseResultCursor(cursor)
+  batches = list(results.iter_batches(3))
+  assert [batch.num_rows for batch in batches] == [3, 1, 3]
+  values = [i for b in batches for i in b.column("id").to_pylist()]
+  assert values == list(range(7))
+  assert cursor.closed
+
+
+def test_cursor_results_fetch_once():
+  cursor = FakeArrowCursor(pyarrow.table({"id": [1, 2]}), 1)
+  results = EncloseResultCursor(cursor)
+  assert results.to_dataframe()["id"].tolist() == [1, 2]
+  assert results.to_arrow() is cursor.table
+  assert cursor.closed
+
+
+class RecordingSnowflakeConnection(SnowflakeConnection):
+  """Answers queries with a canned frame and records the sql it ran."""
+
+  def __init__(self, df):
+    super().__init__()
+    self.df = df
+    self.queries = []
+
+  def _run_query(self, sql, need_data=True, conn=None):
+    self.queries.append(sql)
+    return EncloseResultRows(self.df)
+
+
+def test_fetches_table_schemas_in_one_query():
+  conn = RecordingSnowflakeConnection(
+      pandas.DataFrame({
+          "table_schema": ["MALLOYTEST", "MALLOYTEST", "OTHER"],
+          "table_name": ["AIRPORTS", "AIRPORTS", "FLIGHTS"],
+          "column_name": ["id", "code", "carrier"],
+          "data_type": ["NUMBER", "TEXT", "TEXT"],
+      }))
+  schema = conn.get_schema_for_tables([("airports", "MALLOYTEST.AIRPORTS"),
+                                       ("flights", "FLIGHTS")])
+  assert len(conn.queries) == 1
+  airports = schema["schemas"]["airports"]["fields"]
+  flights = schema["schemas"]["flights"]["fields"]
+  assert [field["name"] for field in airports] == ["id", "code"]
+  assert flights == [{"name": "carrier", "type": "string"}]
+
+
+class FakeSnowflakeCursor(FakeArrowCursor):
+  """A cursor that records statements on its connection."""
+
+  def __init__(self, conn):
+    super().__init__(conn.table, 1)
+    self.conn = conn
+
+  def execute(self, sql):
+    self.conn.statements.append(sql)
+    return self
+
+  def describe(self, sql):
+    self.conn.statements.append(f"DESCRIBE {sql}")
+    if self.conn.metadata is None:
+      raise SnowflakeError("describe is not supported")
+    return self.conn.metadata
+
+  def execute_async(self, sql):
+    self.conn.statements.append(sql)
+    self.sfqid = f"query-{len(self.conn.statements)}"
+    return {"queryId": self.sfqid}
+
+  def get_results_from_sfqid(self, sfqid):
+    self.conn.fetched.append(sfqid)
+
+  def close(self):
+    self.closed = True
+
+
+class FakeSnowflakeConnector:
+  """Stands in for snowflake.connector, counting connects and statements."""
+
+  def __init__(self):
+    self.connects = []
+    self.statements = []
+    self.table = pyarrow.table({"id": [1]})
+    self.metadata = None
+    self.polls_until_done = 0
+    self.fetched = []
+
+  def connect(self, **kwargs):
+    self.connects.append(kwargs)
+    return FakeSnowflakeSession(self)
+
+
+class FakeSnowflakeSession:
+  """Stands in for a snowflake.connector.SnowflakeConnection."""
+
+  def __init__(self, connector):
+    self.connector = connector
+    self.closed = False
+
+  def cursor(self):
+    return FakeSnowflakeCursor(self.connector)
+
+  def is_closed(self):
+    return self.closed
+
+  def is_valid(self):
+    return not self.closed
+
+  def get_query_status_throw_if_error(self, sfqid):
+    del sfqid
+    self.connector.polls_until_done -= 1
+    return self.connector.polls_until_done
+
+  @staticmethod
+  def is_still_running(status):
+    return status >= 0
+
+  def close(self):
+    self.closed = True
+
+
+@pytest.fixture(name="connector")
+def fixture_connector(monkeypatch):
+  connector = FakeSnowflakeConnector()
+  monkeypatch.setattr(snowflake_connection.snowflake, "connect",
+                      connector.connect)
+  return connector
+
+
+def test_sets_session_parameters_once(connector):
+  conn = SnowflakeConnection().with_session_parameters({"TIMEZONE": "UTC"})
+  conn.run_query("SELECT 1").to_arrow()
+  conn.run_query("SELECT 2").to_arrow()
+  assert connector.statements == ["SELECT 1", "SELECT 2"]
+  assert len(connector.connects) == 1
+  assert connector.connects[0]["session_parameters"] == {
+      "QUOTED_IDENTIFIERS_IGNORE_CASE": False,
+      "TIMEZONE": "UTC",
+  }
+
+
+def test_describes_sql_block_schema(connector):
+  connector.metadata = [
+      ResultMetadata("id", 0, None, None, 38, 0, False),
+      ResultMetadata("code", 2, None, 16777216, None, None, True),
+      ResultMetadata("elevation", 1, None, None, None, None, True),
+  ]
+  schema = SnowflakeConnection().get_schema_for_sql_block(
+      "block", "SELECT * FROM malloytest.airports")
+  assert connector.statements == ["DESCRIBE SELECT * FROM malloytest.airports"]
+  assert schema["fields"] == [
+      {
+          "name": "id",
+          "type": "number",
+          "numberType": "integer"
+      },
+      {
+          "name": "code",
+          "type": "string"
+      },
+      {
+          "name": "elevation",
+          "type": "number",
+          "numberType": "float"
+      },
+  ]
+
+
+def test_falls_back_to_temp_table_schema(connector):
+  sql = "SELECT code FROM malloytest.airports"
+  connector.table = pyarrow.table({
+      "table_schema": ["PUBLIC"],
+      "table_name": [f"tt_{hashlib.md5(sql.encode()).hexdigest()}"],
+      "column_name": ["code"],
+      "data_type": ["TEXT"],
+  })
+  schema = SnowflakeConnection().get_schema_for_sql_block("block", sql)
+  assert "CREATE OR REPLACE TEMP TABLE" in connector.statements[1]
+  assert schema["fields"] == [{"name": "code", "type": "string"}]
+
+
+def test_runs_concurrent_queries_on_pooled_connections(connector):
+  conn = SnowflakeConnection().with_pool_options(max_size=2)
+  with conn.connection() as first, conn.connection() as second:
+    assert first is not second
+    assert conn.get_pool().stats()["in_use"] == 2
+  conn.run_query("SELECT 1").to_arrow()
+  assert len(connector.connects) == 2
+  conn.close()
+  assert first.closed and second.closed
+
+
+def test_releases_connection_when_results_are_not_read(connector):
+  conn = SnowflakeConnection().with_pool_options(max_size=1, acquire_timeout=1)
+  unread = [conn.run_query(f"SELECT {i}") for i in range(5)]
+  assert conn.get_pool().stats()["in_use"] == 0
+  assert list(unread[0].iter_batches())[0].num_rows == 1
+  unread[1].close()
+  assert len(connector.connects) == 1
+
+
+def test_reuses_owned_connection(connector):
+  conn = SnowflakeConnection()
+  owned = conn.get_connection()
+  assert owned is conn.get_connection()
+  assert conn.get_pool().stats()["open"] == 0
+  assert len(connector.connects) == 1
+  conn.close()
+  assert owned.closed
+
+
+@pytest.mark.asyncio
+async def test_runs_query_async(connector):
+  connector.polls_until_done = 3
+  conn = SnowflakeConnection()
+  results = await conn.run_query_async("SELECT 1", poll_interval=0.001)
+  assert isinstance(results, EncloseResultCursor)
+  assert conn.get_pool().stats()["in_use"] == 0
+  assert [batch.num_rows for batch in results.iter_batches()] == [1]
+  assert connector.statements == ["SELECT 1"]
+  assert connector.fetched == ["query-1"]
+  assert connector.polls_until_done == -1
+
+
 TEST_QUERY_1 = {
     "sql":
         'SELECT "id", "code" FROM malloytest.airports ORDER BY "id" LIMIT 5',
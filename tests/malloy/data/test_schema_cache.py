@@ -22,10 +22,13 @@
 # test_schema_cache.py
 """Test schema_cache.py"""
 
+import sqlite3
+import time
+
 from absl import logging
 from pathlib import Path
 from malloy.data.duckdb import DuckDbConnection
-from malloy.data.schema_cache import SchemaCache
+from malloy.data.schema_cache import SchemaCache, SqliteSchemaCacheBackend
 
 logging.set_verbosity(logging.ERROR)
 
@@ -44,9 +47,8 @@ def test_saves_schema_to_cache():
   sc = SchemaCache()
   connection = DuckDbConnection(home_dir=home_dir)
   sc.get_schema_for_tables("duckdb", connection, tables)
-  # pylint: disable=protected-access
-  cache = sc._schema_cache
-  assert cache["duckdb"]["duckdb:data/airports.parquet"] is not None
+  assert sc.get_cached_schema("duckdb",
+                              "duckdb:data/airports.parquet") is not None
 
 
 def test_gets_saved_schema():
@@ -57,3 +59,137 @@ def test_gets_saved_schema():
   [cache, uncached_tables] = sc._get_cached_schema("duckdb", tables)
   assert cache["schemas"]["duckdb:data/airports.parquet"] is not None
   assert len(uncached_tables) == 0
+
+
+def test_expires_schema_after_ttl():
+  sc = SchemaCache(ttl=0.05)
+  connection = DuckDbConnection(home_dir=home_dir)
+  sc.get_schema_for_tables("duckdb", connection, tables)
+  time.sleep(0.1)
+  # pylint: disable=protected-access
+  [_, uncached_tables] = sc._get_cached_schema("duckdb", tables)
+  assert uncached_tables == tables
+
+
+def test_invalidates_table_by_key_or_path():
+  sc = SchemaCache()
+  connection = DuckDbConnection(home_dir=home_dir)
+  for table in ["duckdb:data/airports.parquet", "data/airports.parquet"]:
+    sc.get_schema_for_tables("duckdb", connection, tables)
+    sc.invalidate("duckdb", table)
+    assert sc.get_cached_schema("duckdb",
+                                "duckdb:data/airports.parquet") is None
+
+
+def test_sqlite_backend_persists_between_caches(tmp_path):
+  path = tmp_path / "schema_cache.db"
+  connection = DuckDbConnection(home_dir=home_dir)
+  SchemaCache(backend=SqliteSchemaCacheBackend(path)).get_schema_for_tables(
+      "duckdb", connection, tables)
+  sc = SchemaCache(backend=SqliteSchemaCacheBackend(path))
+  schema = sc.get_cached_schema("duckdb", "duckdb:data/airports.parquet")
+  assert schema["structSource"]["tablePath"] == "data/airports.parquet"
+
+  sc.invalidate("duckdb")
+  assert sc.get_cached_schema("duckdb", "duckdb:data/airports.parquet") is None
+
+
+def test_sqlite_backend_clear(tmp_path):
+  sc = SchemaCache(backend=SqliteSchemaCacheBackend(tmp_path / "cache.db"))
+  sc.get_schema_for_tables("duckdb", DuckDbConnection(home_dir=home_dir),
+                           tables)
+  sc.clear()
+  assert sc.get_cached_schema("duckdb", "duckdb:data/airports.parquet") is None
+
+
+def test_sqlite_backend_purges_expired_schemas(tmp_path):
+  path = tmp_path / "cache.db"
+  sc = SchemaCache(backend=SqliteSchemaCacheBackend(path), ttl=0.05)
+  connection = DuckDbConnection(home_dir=home_dir)
+  sc.get_schema_for_tables("duckdb", connection, tables)
+  assert sc.stats()["entries"] == 1
+  time.sleep(0.1)
+  stats = sc.stats()
+  assert stats["entries"] == 0
+  assert stats["bytes"] == 0
+
+  sc.get_schema_for_tables("duckdb", connection, tables)
+  time.sleep(0.1)
+  sc.get_schema_for_tables("duckdb", connection,
+                           [("other", "data/airports.parquet")])
+  with sqlite3.connect(path) as conn:
+    keys = [key for [key] in conn.execute("SELECT key FROM schemas")]
+  assert keys == ["other"]
+
+
+def test_evicts_least_recently_used_schema():
+  sc = SchemaCache(max_entries=2)
+  connection = DuckDbConnection(home_dir=home_dir)
+  for key in ["a", "b"]:
+    sc.get_schema_for_tables("duckdb", connection,
+                             [(key, "data/airports.parquet")])
+  sc.get_schema_for_tables("duckdb", connection,
+                           [("a", "data/airports.parquet")])
+  sc.get_schema_for_tables("duckdb", connection,
+                           [("c", "data/airports.parquet")])
+  assert sc.get_cached_schema("duckdb", "a") is not None
+  assert sc.get_cached_schema("duckdb", "b") is None
+  stats = sc.stats()
+  assert stats["entries"] == 2
+  assert stats["hits"] == 1
+  assert stats["misses"] == 3
+  assert stats["evictions"] == 1
+
+
+def test_evicts_to_stay_under_max_bytes():
+  connection = DuckDbConnection(home_dir=home_dir)
+  sc = SchemaCache()
+  sc.get_schema_for_tables("duckdb", connection, tables)
+  schema_bytes = sc.stats()["bytes"]
+  assert schema_bytes > 0
+
+  sc = SchemaCache(max_bytes=schema_bytes * 2)
+  for key in ["a", "b", "c"]:
+    sc.get_schema_for_tables("duckdb", connection,
+                             [(key, "data/airports.parquet")])
+  stats = sc.stats()
+  assert stats["entries"] == 2
+  assert stats["bytes"] == schema_bytes * 2
+  assert stats["evictions"] == 1
+
+
+class CountingDuckDbConnection(DuckDbConnection):
+  """DuckDbConnection that counts SQL block schema fetches"""
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.sql_block_fetches = 0
+
+  def get_schema_for_sql_block(self, name: str, sql: str):
+    self.sql_block_fetches += 1
+    return super().get_schema_for_sql_block(name, sql)
+
+
+def test_caches_sql_block_schema():
+  sc = SchemaCache()
+  connection = CountingDuckDbConnection(home_dir=home_dir)
+  sql = "SELECT * FROM 'data/airports.parquet'"
+  first = sc.get_schema_for_sql_block("duckdb", connection, "block", sql)
+  second = sc.get_schema_for_sql_block("duckdb", connection, "block", sql)
+  assert first == second
+  assert connection.sql_block_fetches == 1
+
+  sc.get_schema_for_sql_block("duckdb", connection, "block", f"{sql} LIMIT 1")
+  assert connection.sql_block_fetches == 2
+
+
+def test_invalidates_sql_block_schema():
+  sc = SchemaCache()
+  connection = CountingDuckDbConnection(home_dir=home_dir)
+  sql = "SELECT * FROM 'data/airports.parquet'"
+  sc.get_schema_for_sql_block("duckdb", connection, "block", sql)
+  sc.invalidate_sql_block("duckdb", "block", sql)
+  sc.get_schema_for_sql_block("duckdb", connection, "block", sql)
+  sc.invalidate("duckdb")
+  sc.get_schema_for_sql_block("duckdb", connection, "block", sql)
+  assert connection.sql_block_fetches == 3
@@ -0,0 +1,91 @@
+# Copyright 2023 Google LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# test_channel_pool.py
+"""Test channel_pool.py"""
+
+import grpc
+import pytest
+import pytest_asyncio
+
+from malloy.service import ChannelPool
+
+
+@pytest_asyncio.fixture(name="target")
+async def fixture_target():
+  server = grpc.aio.server()
+  port = server.add_insecure_port("localhost:0")
+  await server.start()
+  yield f"localhost:{port}"
+  await server.stop(None)
+
+
+def test_rejects_empty_pool():
+  with pytest.raises(ValueError):
+    ChannelPool(size=0)
+
+
+@pytest.mark.asyncio
+async def test_returns_ready_channel(target):
+  pool = ChannelPool()
+  channel = await pool.get_channel(target)
+  assert channel.get_state() == grpc.ChannelConnectivity.READY
+  pool.close()
+
+
+@pytest.mark.asyncio
+async def test_reuses_channel(target):
+  pool = ChannelPool()
+  channel_1 = await pool.get_channel(target)
+  channel_2 = await pool.get_channel(target)
+  assert channel_1 is channel_2
+  pool.close()
+
+
+@pytest.mark.asyncio
+async def test_round_robins_channels(target):
+  pool = ChannelPool(size=2)
+  channel_1 = await pool.get_channel(target)
+  channel_2 = await pool.get_channel(target)
+  channel_3 = await pool.get_channel(target)
+  assert channel_1 is not channel_2
+  assert channel_1 is channel_3
+  pool.close()
+
+
+@pytest.mark.asyncio
+async def test_replaces_failed_channel():
+  pool = ChannelPool()
+  channel_1 = await pool.get_channel("localhost:1")
+  assert channel_1.get_state() in ChannelPool.error_state
+  channel_2 = await pool.get_channel("localhost:1")
+  assert channel_1 is not channel_2
+  pool.close()
+
+
+@pytest.mark.asyncio
+async def test_discard_opens_new_channel(target):
+  pool = ChannelPool()
+  channel_1 = await pool.get_channel(target)
+  pool.discard(target)
+  channel_2 = await pool.get_channel(target)
+  assert channel_1 is not channel_2
+  pool.close()
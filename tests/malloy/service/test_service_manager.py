@@ -24,9 +24,13 @@
 
 import pytest
 import asyncio
+import os
+import signal
+import time
 from pathlib import Path
 
 from malloy.service import ServiceManager
+from malloy.service import transport
 
 
 def test_is_ready_is_false_when_not_ready():
@@ -52,6 +56,52 @@ async def test_returns_local_service():
   await asyncio.sleep(0.05)
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_starts_service_in_background():
+  sm = ServiceManager()
+  task = sm.start()
+  assert sm.start() is task
+  assert sm.is_ready() is False
+  assert await sm.ready()
+  assert task.done()
+  sm.shutdown()
+  await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_kills_services_on_shutdown_during_start(monkeypatch):
+  spawned = []
+  create_subprocess_exec = asyncio.create_subprocess_exec
+
+  async def record_subprocess(*args, **kwargs):
+    proc = await create_subprocess_exec(*args, **kwargs)
+    spawned.append(proc)
+    return proc
+
+  monkeypatch.setattr(asyncio, "create_subprocess_exec", record_subprocess)
+  sm = ServiceManager(pool_size=2)
+  sm.start()
+  while len(spawned) < 2:
+    await asyncio.sleep(0.01)
+  assert sm.is_ready() is False
+  sm.shutdown()
+  for proc in spawned:
+    await asyncio.wait_for(proc.wait(), 5)
+
+
+@pytest.mark.asyncio
+async def test_ready_times_out():
+  sm = ServiceManager()
+  # pylint: disable-next=protected-access
+  async with sm._spawn_lock:
+    assert await sm.ready(timeout=0.01) is False
+  sm.shutdown()
+
+
 @pytest.mark.asyncio
 async def test_returns_external_service_if_provided():
   external_service = "localhost:54321"
@@ -64,3 +114,152 @@ async def test_returns_external_service_if_provided():
 def test_shutdown_does_not_throw_if_no_proc_started():
   sm = ServiceManager()
   sm.shutdown()
+
+
+def test_rejects_empty_pool():
+  with pytest.raises(ValueError):
+    ServiceManager(pool_size=0)
+
+
+def test_defaults_pool_to_cpu_count():
+  assert ServiceManager(pool_size=None).pool_size() == (os.cpu_count() or 1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_leases_least_loaded_service():
+  sm = ServiceManager(pool_size=2)
+  async with sm.lease() as first, sm.lease() as second:
+    assert first != second
+    assert sm.queue_depths() == {first: 1, second: 1}
+    async with sm.lease() as third:
+      assert third in (first, second)
+      assert sorted(sm.queue_depths().values()) == [1, 2]
+  assert sm.queue_depths() == {first: 0, second: 0}
+  sm.shutdown()
+  await asyncio.sleep(0.05)
+
+
+async def wait_for_restart(sm, target):
+  for _ in range(100):
+    if sm.restart_counts() and target not in sm.restart_counts():
+      return
+    await asyncio.sleep(0.1)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_restarts_exited_service():
+  sm = ServiceManager()
+  service = await sm.get_service()
+  # pylint: disable=protected-access
+  sm._processes[0].proc.kill()
+  await wait_for_restart(sm, service)
+  restarted = await sm.get_service()
+  assert restarted != service
+  assert sm.restart_counts() == {restarted: 1}
+  assert await sm._is_healthy(restarted)
+  sm.shutdown()
+  await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_restarts_unresponsive_service():
+  sm = ServiceManager(health_check_interval=0.2, health_check_timeout=0.5)
+  service = await sm.get_service()
+  # pylint: disable=protected-access
+  sm._processes[0].proc.send_signal(signal.SIGSTOP)
+  await wait_for_restart(sm, service)
+  assert sm.restart_counts() == {await sm.get_service(): 1}
+  sm.shutdown()
+  await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_keeps_healthy_service_on_reported_failure():
+  sm = ServiceManager()
+  service = await sm.get_service()
+  await sm.report_failure(service)
+  assert sm.restart_counts() == {service: 0}
+  sm.shutdown()
+  await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_shares_service_between_managers(tmp_path):
+  first = ServiceManager(shared=True, shared_state_dir=tmp_path)
+  second = ServiceManager(shared=True, shared_state_dir=tmp_path)
+  service = await first.get_service()
+  assert await second.get_service() == service
+  assert first.pool_size() == 1
+  first.shutdown()
+  assert await second._is_healthy(service)  # pylint: disable=protected-access
+  started = time.monotonic()
+  second.shutdown()
+  # Stopping the daemon happens off the event loop.
+  assert time.monotonic() - started < 0.5
+  for _ in range(100):
+    if not transport.accepts(service):
+      break
+    await asyncio.sleep(0.05)
+  assert not transport.accepts(service)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_listens_on_unix_socket():
+  sm = ServiceManager(transport_type="unix")
+  service = await sm.get_service()
+  assert service.startswith("unix:")
+  assert await sm._is_healthy(service)  # pylint: disable=protected-access
+  socket_path = Path(service[len("unix:"):])
+  sm.shutdown()
+  await asyncio.sleep(0.05)
+  assert not socket_path.parent.exists()
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_restarts_unsupervised_service_on_reported_failure():
+  sm = ServiceManager(supervise=False)
+  service = await sm.get_service()
+  # pylint: disable=protected-access
+  sm._processes[0].proc.kill()
+  await sm._processes[0].proc.wait()
+  await sm.report_failure(service)
+  restarted = await sm.get_service()
+  assert restarted != service
+  assert sm.restart_counts() == {restarted: 1}
+  assert await sm._is_healthy(restarted)
+  sm.shutdown()
+  await asyncio.sleep(0.05)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not Path(ServiceManager.service_path()).exists(),
+                    reason=f"Could not find: {ServiceManager.service_path()}")
+async def test_stops_reporting_ready_when_restart_fails(monkeypatch):
+  sm = ServiceManager(supervise=False)
+  service = await sm.get_service()
+
+  async def fail_to_start():
+    return None
+
+  # pylint: disable=protected-access
+  monkeypatch.setattr(sm, "_start_process", fail_to_start)
+  sm._processes[0].proc.kill()
+  await sm._processes[0].proc.wait()
+  await sm.report_failure(service)
+  assert sm.is_ready() is False
+  assert not sm.queue_depths()
+  sm.shutdown()
@@ -0,0 +1,115 @@
+# Copyright 2023 Google LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# test_shared_service.py
+"""Test shared_service.py"""
+
+import subprocess
+import sys
+import time
+import pytest
+
+from pathlib import Path
+
+from malloy.service import ServiceManager
+from malloy.service import shared_service
+from malloy.service.shared_service import SharedService
+from malloy.service.transport import accepts
+
+pytestmark = pytest.mark.skipif(
+    not Path(ServiceManager.service_path()).exists(),
+    reason=f"Could not find: {ServiceManager.service_path()}")
+
+ATTACH_AND_EXIT = """
+import sys
+from malloy.service.shared_service import SharedService
+print(SharedService(sys.argv[1], [], sys.argv[2]).attach())
+"""
+
+
+def new_service(state_dir):
+  return SharedService(ServiceManager.service_path(), [], state_dir)
+
+
+def test_clients_share_one_daemon(tmp_path):
+  first = new_service(tmp_path)
+  second = new_service(tmp_path)
+  target = first.attach()
+  assert second.attach() == target
+  assert len(first.clients()) == 2
+  first.detach()
+  assert accepts(target)
+  second.detach()
+  assert not accepts(target)
+
+
+def test_reuses_daemon_across_processes(tmp_path):
+  service = new_service(tmp_path)
+  target = service.attach()
+  args = [ServiceManager.service_path(), str(tmp_path)]
+  child = subprocess.run([sys.executable, "-c", ATTACH_AND_EXIT, *args],
+                         capture_output=True,
+                         text=True,
+                         check=True)
+  assert child.stdout.strip() == target
+  # The child detached when it exited, the daemon is still ours.
+  assert len(service.clients()) == 1
+  assert accepts(target)
+  service.detach()
+  assert not accepts(target)
+
+
+def test_replaces_stopped_daemon(tmp_path):
+  first = new_service(tmp_path)
+  target = first.attach()
+  # pylint: disable-next=protected-access
+  first._stop(first._read_state()["pid"], target)
+  second = new_service(tmp_path)
+  replacement = second.attach()
+  assert replacement != target
+  assert len(second.clients()) == 2
+  first.detach()
+  second.detach()
+  assert not accepts(replacement)
+
+
+def test_shares_daemon_over_unix_socket(tmp_path):
+  service = SharedService(ServiceManager.service_path(), [], tmp_path, "unix")
+  target = service.attach()
+  assert target.startswith(f"unix:{tmp_path}")
+  assert accepts(target)
+  service.detach()
+  assert not Path(target[len("unix:"):]).exists()
+
+
+def test_stops_daemon_spawned_by_another_process(tmp_path):
+  service = new_service(tmp_path)
+  target = service.attach()
+  # pylint: disable-next=protected-access
+  pid = service._read_state()["pid"]
+  # As if another process spawned it, the daemon is not reaped here and
+  # lingers as a zombie once stopped.
+  proc = shared_service._spawned.pop(pid)  # pylint: disable=protected-access
+  started = time.monotonic()
+  service.detach()
+  assert time.monotonic() - started < 5
+  assert not accepts(target)
+  proc.wait()
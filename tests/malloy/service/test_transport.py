@@ -0,0 +1,62 @@
+# Copyright 2023 Google LLC
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# test_transport.py
+"""Test transport.py"""
+
+import socket
+import pytest
+
+from pathlib import Path
+
+from malloy.service import transport
+
+
+def test_rejects_unknown_transport():
+  with pytest.raises(ValueError):
+    transport.check_transport("pipe")
+
+
+def test_listens_on_tcp_port():
+  assert transport.listen_args() == ["-p", "0"]
+  assert transport.target("14310") == "localhost:14310"
+
+
+def test_listens_on_unix_socket(tmp_path):
+  socket_path = Path(tmp_path, "service")
+  Path(f"{socket_path}:0").touch()
+  assert transport.listen_args(socket_path) == [
+      "-h", f"unix:{socket_path}", "-p", "0"
+  ]
+  assert not Path(f"{socket_path}:0").exists()
+  assert transport.target("1", socket_path) == f"unix:{socket_path}:0"
+
+
+def test_checks_unix_socket_accepts(tmp_path):
+  socket_path = Path(tmp_path, "service:0")
+  service = f"unix:{socket_path}"
+  assert not transport.accepts(service)
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+    server.bind(str(socket_path))
+    server.listen()
+    assert transport.accepts(service)
+  transport.remove_socket(service)
+  assert not socket_path.exists()
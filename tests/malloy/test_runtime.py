@@ -23,16 +23,21 @@
 """Test runtime.py"""
 
 import asyncio
+import contextlib
 import json
 import re
+import threading
+import time
 import pytest
 import pytest_asyncio
 
 from absl import logging
 from pathlib import Path
 from malloy import Runtime
+from malloy.runtime import MalloyRuntimeError
 from malloy.service import ServiceManager
 from malloy.data.duckdb import DuckDbConnection
+from malloy.data.schema_cache import SchemaCache
 from malloy.data.snowflake import SnowflakeConnection
 from snowflake.connector import Error as SnowflakeError
 
@@ -100,6 +105,226 @@ ORDER BY 2 desc NULLS LAST
   assert connection == "duckdb"
 
 
+@pytest.mark.asyncio
+async def test_concurrent_compiles_on_one_runtime(service_manager):
+  rt = Runtime(service_manager=service_manager)
+  rt.add_connection(DuckDbConnection(home_dir=home_dir))
+  rt.load_file(test_file_01)
+  queries = [
+      f"run: airports -> {{ group_by: state; limit: {i + 1} }}"
+      for i in range(100)
+  ]
+  results = await asyncio.gather(*[rt.get_sql(query=q) for q in queries])
+  for i, [sql, connection] in enumerate(results):
+    assert connection == "duckdb"
+    assert sql.rstrip().endswith(f"LIMIT {i + 1}")
+
+
+class RecordingServiceManager(ServiceManager):
+  """ServiceManager that records which service each compile went to"""
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.targets = []
+
+  @contextlib.asynccontextmanager
+  async def lease(self):
+    async with super().lease() as target:
+      self.targets.append(target)
+      yield target
+
+
+@pytest.mark.asyncio
+async def test_spreads_compiles_across_service_pool():
+  service_manager = RecordingServiceManager(pool_size=2)
+  rt = Runtime(service_manager=service_manager)
+  rt.add_connection(DuckDbConnection(home_dir=home_dir))
+  rt.load_file(test_file_01)
+  queries = [
+      f"run: airports -> {{ group_by: state; limit: {i + 1} }}"
+      for i in range(10)
+  ]
+  results = await asyncio.gather(*[rt.get_sql(query=q) for q in queries])
+  assert all(sql is not None for [sql, _] in results)
+  assert len(set(service_manager.targets)) == 2
+  rt.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_retries_compile_after_service_crash():
+  service_manager = ServiceManager()
+  rt = Runtime(service_manager=service_manager)
+  rt.add_connection(DuckDbConnection(home_dir=home_dir))
+  rt.load_file(test_file_01)
+  [sql, _] = await rt.get_sql(query=query_by_state)
+  assert sql is not None
+  # pylint: disable-next=protected-access
+  service_manager._processes[0].proc.kill()
+  [sql, _] = await rt.get_sql(query="run: airports -> { group_by: county }")
+  assert sql is not None
+  rt.shutdown()
+
+
+def test_skips_warm_up_without_event_loop():
+  rt = Runtime(service_manager=ServiceManager(), warm_up=True)
+  rt.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_warms_up_in_background():
+  service_manager = ServiceManager()
+  rt = Runtime(service_manager=service_manager, warm_up=True)
+  assert rt.warm_up() is rt.warm_up()
+  assert await rt.ready()
+  assert service_manager.is_ready()
+  rt.add_connection(DuckDbConnection(home_dir=home_dir))
+  rt.load_file(test_file_01)
+  [sql, _] = await rt.get_sql(query=query_by_state)
+  assert sql is not None
+  rt.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_compiles_over_unix_socket():
+  rt = Runtime(service_manager=ServiceManager(transport_type="unix"))
+  rt.add_connection(DuckDbConnection(home_dir=home_dir))
+  rt.load_file(test_file_01)
+  [sql, _] = await rt.get_sql(query=query_by_state)
+  assert sql is not None
+  rt.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_reuses_cached_compile(service_manager):
+  rt = Runtime(service_manager=service_manager)
+  rt.add_connection(DuckDbConnection(home_dir=home_dir))
+  rt.load_file(test_file_01)
+  first = await rt.get_sql(query=query_by_state)
+  second = await rt.get_sql(query=query_by_state)
+  assert first == second
+  stats = rt.get_compile_cache_stats()
+  assert stats["hits"] == 1
+  assert stats["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_recompiles_when_import_changes(service_manager, tmp_path):
+  Path(tmp_path, "base.malloy").write_text(
+      f"source: airports is duckdb.table('{home_dir}/data/airports.parquet')")
+  Path(tmp_path, "model.malloy").write_text("import 'base.malloy'")
+  rt = Runtime(service_manager=service_manager)
+  rt.add_connection(DuckDbConnection(home_dir=home_dir))
+  rt.load_file(f"{tmp_path}/model.malloy")
+  query = "run: airports -> { group_by: state }"
+  [sql, _] = await rt.get_sql(query=query)
+  assert '"state"' in sql
+
+  Path(tmp_path, "base.malloy").write_text(
+      f"source: airports is duckdb.table('{home_dir}/data/airports.parquet')"
+      " extend { rename: province is state }")
+  with pytest.raises(MalloyRuntimeError):
+    await rt.get_sql(query=query)
+  assert rt.get_compile_cache_stats()["hits"] == 0
+
+
+@pytest.mark.asyncio
+async def test_caches_sql_block_schema(service_manager):
+  schema_cache = SchemaCache()
+  rt = Runtime(service_manager=service_manager, schema_cache=schema_cache)
+  rt.add_connection(DuckDbConnection(home_dir=home_dir))
+  rt.load_source(
+      "source: airports is duckdb.sql(\"SELECT * FROM 'data/airports.parquet'\")"
+  )
+  await rt.get_sql(query="run: airports -> { group_by: state }")
+  await rt.get_sql(query="run: airports -> { group_by: county }")
+  stats = schema_cache.stats()
+  assert stats["misses"] == 1
+  assert stats["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_resolves_sql_block_paths_per_cursor(service_manager):
+  rt = Runtime(service_manager=service_manager)
+  rt.add_connection(DuckDbConnection(search_path_per_cursor=True))
+  rt.load_source(
+      "source: airports is duckdb.sql(\"SELECT * FROM 'data/airports.parquet'\")",
+      import_path=home_dir)
+  [sql, _] = await rt.get_sql(query="run: airports -> { group_by: state }")
+  assert sql is not None
+
+
+JOINED_SOURCE = """
+source: a is duckdb.table('data/airports.parquet')
+source: b is duckdb.table('./data/airports.parquet')
+source: c is duckdb.table('data/../data/airports.parquet')
+source: abc is a extend {
+  join_one: b on b.id = id
+  join_one: c on c.id = id
+}"""
+
+
+class SlowDuckDbConnection(DuckDbConnection):
+  """DuckDbConnection that tracks how many schema fetches overlap"""
+  batches_schema_lookups = False
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self._lock = threading.Lock()
+    self.running = 0
+    self.max_running = 0
+    self.fetches = []
+
+  def get_schema_for_tables(self, tables):
+    self.fetches.append(len(tables))
+    with self._lock:
+      self.running += 1
+      self.max_running = max(self.running, self.max_running)
+    time.sleep(0.2)
+    with self._lock:
+      self.running -= 1
+    return super().get_schema_for_tables(tables)
+
+
+@pytest.mark.asyncio
+async def test_fetches_table_schemas_concurrently(service_manager):
+  connection = SlowDuckDbConnection(home_dir=home_dir)
+  rt = Runtime(service_manager=service_manager, schema_fetch_concurrency=2)
+  rt.add_connection(connection)
+  rt.load_source(JOINED_SOURCE, import_path=home_dir)
+  [sql, _] = await rt.get_sql(query="run: abc -> { group_by: b.state }")
+  assert sql is not None
+  assert connection.max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_limits_schema_fetches_across_compiles(service_manager):
+  connection = SlowDuckDbConnection(home_dir=home_dir)
+  # Nothing is cached, so both compiles fetch every schema.
+  rt = Runtime(service_manager=service_manager,
+               schema_cache=SchemaCache(max_entries=0))
+  rt.add_connection(connection).with_schema_fetch_concurrency("duckdb", 1)
+  rt.load_source(JOINED_SOURCE, import_path=home_dir)
+  results = await asyncio.gather(
+      rt.get_sql(query="run: abc -> { group_by: b.state }"),
+      rt.get_sql(query="run: abc -> { group_by: c.county }"))
+  assert all(sql is not None for [sql, _] in results)
+  assert connection.fetches == [3, 3]
+  assert connection.max_running == 1
+  rt.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_batches_schema_fetches_when_supported(service_manager):
+  connection = SlowDuckDbConnection(home_dir=home_dir)
+  connection.batches_schema_lookups = True
+  rt = Runtime(service_manager=service_manager, schema_fetch_concurrency=4)
+  rt.add_connection(connection)
+  rt.load_source(JOINED_SOURCE, import_path=home_dir)
+  [sql, _] = await rt.get_sql(query="run: abc -> { group_by: b.state }")
+  assert sql is not None
+  assert connection.fetches == [3]
+
+
 @pytest.mark.asyncio
 async def test_runs_sql(service_manager):
   rt = Runtime(service_manager=service_manager)
@@ -113,6 +338,42 @@ async def test_runs_sql(service_manager):
   assert df_data["airport_count"][22] == 400
 
 
+class AsyncDuckDbConnection(DuckDbConnection):
+  """DuckDbConnection with an async query path"""
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.async_queries = 0
+
+  async def run_query_async(self, sql):
+    self.async_queries += 1
+    return self.run_query(sql)
+
+
+@pytest.mark.asyncio
+async def test_runs_sql_block_against_connection_home_dir(
+    service_manager, tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  rt = Runtime(service_manager=service_manager)
+  rt.add_connection(DuckDbConnection(home_dir=home_dir))
+  rt.load_source(
+      "source: airports is duckdb.sql(\"SELECT * FROM 'data/airports.parquet'\")"
+  )
+  data = await rt.run(query="run: airports -> { group_by: state }")
+  assert len(data.to_dataframe()) > 0
+
+
+@pytest.mark.asyncio
+async def test_runs_sql_async_when_supported(service_manager):
+  connection = AsyncDuckDbConnection(home_dir=home_dir)
+  rt = Runtime(service_manager=service_manager)
+  rt.add_connection(connection)
+  rt.load_file(test_file_01)
+  data = await rt.run(query=query_by_state)
+  assert data.to_dataframe()["state"][0] == "TX"
+  assert connection.async_queries == 1
+
+
 @pytest.mark.asyncio
 async def test_with():
   with Runtime() as rt: